@@ -6,8 +6,15 @@
 
 import copy
 import math
+import numpy as np
 import torch
+from collections import OrderedDict
+from functools import partial
+from pathlib import Path
 from torch import nn
+from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+from torch.utils.hooks import RemovableHandle
 
 
 def attention(
@@ -22,7 +29,9 @@ def attention(
             scores = scores + bias[:, None, None, :]
 
     if mask is not None:
-        scores = scores.masked_fill(mask == 0, -10000.0)
+        # in place, since scores is a new tensor here (from the division or the
+        # bias addition) that no other op keeps for the backward pass
+        scores.masked_fill_(mask == 0, -10000.0)
 
     p_attn = torch.softmax(scores, dim=-1)
 
@@ -31,21 +40,129 @@ def attention(
     return torch.matmul(p_attn, value), p_attn
 
 
+def chunked_attention(
+    query,
+    key,
+    value,
+    mask=None,
+    dropout=None,
+    bias=None,
+    attn_bias_type=None,
+    chunk_size=128,
+):
+    """Same as attention, but one chunk_size x chunk_size block of scores at a time.
+
+    The softmax is computed online over the key blocks with a running maximum
+    and sum, and dropout is applied to its numerator. The attention
+    probabilities are not returned.
+    """
+    d_k = query.size(-1)
+    q_len, k_len = query.size(-2), key.size(-2)
+
+    outputs = []
+    for q_start in range(0, q_len, chunk_size):
+        q_end = min(q_start + chunk_size, q_len)
+        q = query[..., q_start:q_end, :]
+        row_max = row_sum = output = None
+        for k_start in range(0, k_len, chunk_size):
+            k_end = min(k_start + chunk_size, k_len)
+            scores = torch.matmul(
+                q, key[..., k_start:k_end, :].transpose(-2, -1)
+            ) / math.sqrt(d_k)
+
+            if bias is not None:
+                if attn_bias_type == "dot":
+                    scores = scores + bias[:, None, None, k_start:k_end]
+
+            if mask is not None:
+                m = mask[..., k_start:k_end]
+                if m.size(-2) > 1:
+                    m = m[..., q_start:q_end, :]
+                scores.masked_fill_(m == 0, -10000.0)
+
+            # the maximum only keeps exp() in range; it cancels out in the gradient
+            block_max = scores.detach().amax(dim=-1, keepdim=True)
+            new_max = block_max if row_max is None else torch.max(row_max, block_max)
+            # exp() is slow on CPU for very negative inputs such as the masked
+            # scores; they only differ from 0 by less than e^-80 anyway
+            p = scores.sub_(new_max).clamp(min=-80.0).exp_()
+            block_sum = p.sum(dim=-1, keepdim=True)
+            if dropout is not None:
+                p = dropout(p)
+            block_output = torch.matmul(p, value[..., k_start:k_end, :])
+
+            if row_max is None:
+                row_sum, output = block_sum, block_output
+            else:
+                scale = torch.exp(row_max - new_max)
+                row_sum = row_sum.mul_(scale).add_(block_sum)
+                output = output.mul_(scale).add_(block_output)
+            row_max = new_max
+        outputs.append(output / row_sum)
+    return torch.cat(outputs, dim=-2), None
+
+
+ATTENTION_BACKENDS = {
+    "reference": attention,
+    "chunked": chunked_attention,
+}
+
+
 class MultiHeadedAttention(nn.Module):
-    def __init__(self, config, attn_bias_type=None):
+    def __init__(
+        self,
+        config,
+        attn_bias_type=None,
+        backend="reference",
+        chunk_size=128,
+        retain_attn=False,
+    ):
         super().__init__()
         assert config.hidden_size % config.num_attention_heads == 0
         self.d_k = config.hidden_size // config.num_attention_heads
         self.h = config.num_attention_heads
         self.linears = self.clones(nn.Linear(config.hidden_size, config.hidden_size), 4)
-        self.attn = None
+        self.attn = None  # the last attention probabilities, with retain_attn
+        self.retain_attn = retain_attn
+        self.attn_hooks = OrderedDict()
+        self.gradient_checkpointing = False
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
         self.attn_bias_type = attn_bias_type
+        self.set_backend(backend, chunk_size)
+
+    def set_backend(self, backend, chunk_size=None):
+        assert backend in ATTENTION_BACKENDS
+        self.backend = backend
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
+    def register_attn_hook(self, hook):
+        """Call hook(module, attn) with the attention probabilities of each forward."""
+        handle = RemovableHandle(self.attn_hooks)
+        self.attn_hooks[handle.id] = hook
+        return handle
 
     def clones(self, module, N):
         return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
 
     def forward(self, query, key, value, mask=None, bias=None):
+        # recompute the attention in the backward pass instead of keeping its
+        # activations (not with hooks, which would see it twice). checkpoint
+        # only backpropagates to self.linears if one of the inputs requires
+        # grad, which is not the case on top of a frozen encoder
+        if (
+            self.gradient_checkpointing
+            and self.training
+            and torch.is_grad_enabled()
+            and not (self.retain_attn or self.attn_hooks)
+            and any(
+                x is not None and x.requires_grad for x in (query, key, value, bias)
+            )
+        ):
+            return checkpoint(self._forward, query, key, value, mask, bias)
+        return self._forward(query, key, value, mask, bias)
+
+    def _forward(self, query, key, value, mask=None, bias=None):
         if mask is not None:
             mask = mask.unsqueeze(1)
 
@@ -64,11 +181,18 @@ class MultiHeadedAttention(nn.Module):
 
         n_b = query.size(0)
         query, key, value = [
-            lin(x).view(n_b, -1, self.h, self.d_k).transpose(1, 2)
-            for lin, x in zip(self.linears, (query, key, value))
+            x.view(n_b, -1, self.h, self.d_k).transpose(1, 2)
+            for x in self.project(query, key, value)
         ]
 
-        x, self.attn = attention(
+        # only the reference backend gives the attention probabilities
+        backend = self.backend
+        if self.retain_attn or self.attn_hooks:
+            backend = "reference"
+        kwargs = {}
+        if backend != "reference":
+            kwargs["chunk_size"] = self.chunk_size
+        x, attn = ATTENTION_BACKENDS[backend](
             query,
             key,
             value,
@@ -76,17 +200,100 @@ class MultiHeadedAttention(nn.Module):
             dropout=self.dropout,
             bias=bias,
             attn_bias_type=self.attn_bias_type,
+            **kwargs,
         )
+        self.attn = attn.detach() if self.retain_attn else None
+        for hook in self.attn_hooks.values():
+            hook(self, attn.detach())
 
         x = x.transpose(1, 2).contiguous().view(n_b, -1, self.h * self.d_k)
         return self.linears[-1](x)
 
+    def project(self, query, key, value):
+        if self.backend == "reference":
+            return [lin(x) for lin, x in zip(self.linears, (query, key, value))]
+
+        # one matmul for the projections that share their input (the weights
+        # stay in self.linears, so checkpoints load with any backend)
+        def fused(x, linears):
+            weight = torch.cat([lin.weight for lin in linears])
+            bias = torch.cat([lin.bias for lin in linears])
+            return F.linear(x, weight, bias).chunk(len(linears), dim=-1)
+
+        q_lin, k_lin, v_lin = self.linears[:3]
+        if query is key and key is value:
+            return fused(query, [q_lin, k_lin, v_lin])
+        if key is value:
+            return [q_lin(query), *fused(key, [k_lin, v_lin])]
+        return [q_lin(query), k_lin(key), v_lin(value)]
+
+
+def set_attn_backend(module, backend, chunk_size=None):
+    """Switch every MultiHeadedAttention in `module` to `backend`."""
+    for m in module.modules():
+        if isinstance(m, MultiHeadedAttention):
+            m.set_backend(backend, chunk_size)
+
+
+def set_gradient_checkpointing(module, gradient_checkpointing=True):
+    """Checkpoint every MultiHeadedAttention in `module` during training."""
+    for m in module.modules():
+        if isinstance(m, MultiHeadedAttention):
+            m.gradient_checkpointing = gradient_checkpointing
+
+
+def set_retain_attn(module, retain_attn=True):
+    """Keep the last attention probabilities of every MultiHeadedAttention in `module`."""
+    for m in module.modules():
+        if isinstance(m, MultiHeadedAttention):
+            m.retain_attn = retain_attn
+            m.attn = None
+
+
+class AttentionWriter:
+    """Write the attention probabilities of every MultiHeadedAttention in `model`.
+
+    The hooks collect the maps of a batch; write() saves them with the given
+    arrays (e.g., the rows of the batch) to out_dir/{batch index:05d}.npz,
+    keyed by module name.
+    """
+
+    def __init__(self, model, out_dir, dtype=np.float16):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.dtype = dtype
+        self.maps = {}
+        self.num_batches = 0
+        self.handles = [
+            m.register_attn_hook(partial(self.collect, name))
+            for name, m in model.named_modules()
+            if isinstance(m, MultiHeadedAttention)
+        ]
+
+    def collect(self, name, module, attn):
+        self.maps[name] = attn.cpu().numpy().astype(self.dtype)
+
+    def write(self, **arrays):
+        np.savez(self.out_dir / f"{self.num_batches:05d}.npz", **arrays, **self.maps)
+        self.maps = {}
+        self.num_batches += 1
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
 
 class SelfAttention(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, backend="reference", chunk_size=128):
         super().__init__()
-        self.self_attn = MultiHeadedAttention(config)
+        self.self_attn = MultiHeadedAttention(
+            config, backend=backend, chunk_size=chunk_size
+        )
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, x, mask=None, bias=None):
-        return x + self.dropout(self.self_attn(x, x, x, mask, bias))
+    def forward(self, x, mask=None, bias=None, memory=None):
+        # with memory, x attends over memory instead of itself
+        if memory is None:
+            memory = x
+        return x + self.dropout(self.self_attn(x, memory, memory, mask, bias))
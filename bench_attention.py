@@ -0,0 +1,103 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import argparse
+import multiprocessing as mp
+import time
+import torch
+from types import SimpleNamespace
+from attentions import SelfAttention
+
+
+def build_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden_size", type=int, default=768)
+    parser.add_argument("--num_attention_heads", type=int, default=12)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[128, 320, 640, 1280])
+    parser.add_argument("--chunk_size", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--backward", action="store_true")
+    return parser.parse_args()
+
+
+def make_config(args, dropout=0.0):
+    return SimpleNamespace(
+        hidden_size=args.hidden_size,
+        num_attention_heads=args.num_attention_heads,
+        attention_probs_dropout_prob=dropout,
+        hidden_dropout_prob=dropout,
+    )
+
+
+def make_mask(batch_size, length):
+    # random padding; the last example is fully masked
+    lengths = torch.randint(1, length + 1, (batch_size,))
+    lengths[-1] = 0
+    return (torch.arange(length) < lengths.unsqueeze(1)).long()
+
+
+def read_status(key):
+    # in kB
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key + ":"):
+                return int(line.split()[1])
+
+
+def reset_peak_rss():
+    # linux only: make VmHWM the current VmRSS
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    return read_status("VmRSS")
+
+
+def measure(args, backend, length):
+    torch.manual_seed(0)
+    module = SelfAttention(make_config(args), backend, args.chunk_size)
+    x = torch.randn(args.batch_size, length, args.hidden_size)
+    mask = make_mask(args.batch_size, length).unsqueeze(1)
+    if args.backward:
+        x.requires_grad_()
+        module.train()
+    else:
+        module.eval()
+
+    def step():
+        with torch.set_grad_enabled(args.backward):
+            y = module(x, mask)
+            if args.backward:
+                y.sum().backward()
+
+    # peak resident set size of the first step above the current one
+    rss_start = reset_peak_rss()
+    step()
+    rss_peak = read_status("VmHWM") - rss_start
+
+    t_start = time.perf_counter()
+    for _ in range(args.repeat):
+        step()
+    t_step = (time.perf_counter() - t_start) / args.repeat
+    return t_step, rss_peak / 1024
+
+
+def main():
+    args = build_args()
+
+    # test_attentions.py checks that both backends give the same results
+    mode = "forward+backward" if args.backward else "forward"
+    print(f"{mode}, batch {args.batch_size}, chunk {args.chunk_size}")
+    ctx = mp.get_context("spawn")
+    for length in args.lengths:
+        for backend in ["reference", "chunked"]:
+            with ctx.Pool(1) as p:
+                t_step, peak_mb = p.apply(measure, (args, backend, length))
+            print(
+                f"len {length:5d} {backend:>9}: {t_step * 1000:8.1f} ms, "
+                f"peak +{peak_mb:7.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
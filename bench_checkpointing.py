@@ -0,0 +1,120 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import argparse
+import multiprocessing as mp
+import time
+import torch
+from bench_attention import read_status, reset_peak_rss
+from modeling_verification import VerificationJointModel
+
+
+def build_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--pretrained_model_name", type=str, default="bert-base-uncased"
+    )
+    parser.add_argument("--max_seq_length", type=int, default=128)
+    parser.add_argument("--num_evidence", type=int, default=5)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--aggregate_mode", type=str, default="attn")
+    parser.add_argument("--attn_bias_type", type=str, default="dot")
+    parser.add_argument("--attn_backend", type=str, default="reference")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cpu")
+    return parser.parse_args()
+
+
+def reset_peak(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        return torch.cuda.memory_allocated(device)
+    return reset_peak_rss() * 1024
+
+
+def read_peak(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    return read_status("VmHWM") * 1024
+
+
+def measure(args, model, batch_size, device):
+    # claims with evidence of random lengths, as in a training step
+    shape = (batch_size, args.num_evidence + 1, args.max_seq_length)
+    input_ids = torch.randint(1000, 2000, shape, device=device)
+    lengths = torch.randint(8, args.max_seq_length + 1, shape[:2] + (1,))
+    attention_mask = (torch.arange(args.max_seq_length) < lengths).long().to(device)
+    labels = torch.randint(0, model.num_labels, (batch_size,), device=device)
+    selection_labels = torch.randint(0, 2, shape[:2], device=device)
+
+    def step():
+        outputs = model(
+            input_ids,
+            attention_mask=attention_mask,
+            labels=labels,
+            selection_labels=selection_labels,
+            return_dict=True,
+        )
+        outputs.loss.backward()
+        model.zero_grad()
+
+    # the peak of the first step includes the gradients of the parameters
+    memory_start = reset_peak(device)
+    step()
+    peak = read_peak(device) - memory_start
+
+    t_start = time.perf_counter()
+    for _ in range(args.repeat):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    t_step = (time.perf_counter() - t_start) / args.repeat
+    return t_step, peak / (1 << 20)
+
+
+def run(args, batch_size, gradient_checkpointing):
+    device = torch.device(args.device)
+    hparams = argparse.Namespace(
+        pretrained_model_name=args.pretrained_model_name,
+        num_evidence=args.num_evidence,
+        max_seq_length=args.max_seq_length,
+        aggregate_mode=args.aggregate_mode,
+        attn_bias_type=args.attn_bias_type,
+        attn_backend=args.attn_backend,
+        word_attn=True,
+        sent_attn=True,
+        classifier_dropout_prob=0.1,
+        lambda_joint=1.0,
+        gradient_checkpointing=gradient_checkpointing,
+    )
+    torch.manual_seed(0)
+    model = VerificationJointModel(hparams, num_labels=3).to(device).train()
+    return measure(args, model, batch_size, device)
+
+
+def main():
+    args = build_args()
+
+    print(
+        f"{args.pretrained_model_name}, num_evidence {args.num_evidence}, "
+        f"max_seq_length {args.max_seq_length}, word_attn + sent_attn"
+    )
+    ctx = mp.get_context("spawn")
+    for batch_size in args.batch_sizes:
+        for gradient_checkpointing in [False, True]:
+            # a fresh process for each setting, so their peaks do not mix
+            with ctx.Pool(1) as p:
+                t_step, peak_mb = p.apply(
+                    run, (args, batch_size, gradient_checkpointing)
+                )
+            print(
+                f"batch {batch_size:3d} checkpointing={gradient_checkpointing!s:>5}: "
+                f"{t_step * 1000:8.1f} ms/step, peak +{peak_mb:8.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
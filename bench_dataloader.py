@@ -0,0 +1,59 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import argparse
+import time
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+from feature_utils import (
+    BatchDataset,
+    FeatureDataset,
+    FeatureStore,
+    RowBatchSampler,
+    is_feature_store,
+)
+
+
+def build_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--feature_file", type=str, required=True)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--shuffle", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = build_args()
+
+    if is_feature_store(args.feature_file):
+        dataset = FeatureStore(args.feature_file)
+    else:
+        dataset = FeatureDataset(torch.load(args.feature_file))
+    print(f"{len(dataset)} rows")
+
+    sampler = RowBatchSampler(len(dataset), args.batch_size, shuffle=args.shuffle)
+    batches = list(sampler)
+
+    t_start = time.perf_counter()
+    row_batches = [default_collate([dataset[i] for i in b]) for b in batches]
+    t_rows = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    loader = DataLoader(BatchDataset(dataset), sampler=sampler, batch_size=None)
+    whole_batches = list(loader)
+    t_batches = time.perf_counter() - t_start
+
+    assert len(row_batches) == len(whole_batches)
+    for a, b in zip(row_batches, whole_batches):
+        assert a.keys() == b.keys()
+        assert all(torch.equal(a[k], b[k]) for k in a)
+
+    for name, t in [("rows", t_rows), ("batches", t_batches)]:
+        print(f"{name:>8}: {t:.3f}s ({len(batches) / t:.0f} batches/s)")
+    print(f"Speedup: {t_rows / t_batches:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import argparse
+import jsonlines
+import random
+import time
+from fever_doc_db import FeverDocDB
+
+
+def get_doc_ids(in_file, max_claims):
+    doc_ids = []
+    for i, line in enumerate(jsonlines.open(in_file)):
+        if max_claims is not None and i >= max_claims:
+            break
+        evidence = line.get("evidence", [])
+        gold_docs = [e[2] for es in evidence for e in es if e[2] is not None]
+        doc_ids.append(list(set(gold_docs + line["predicted_pages"])))
+    return doc_ids
+
+
+def run_per_id(db, doc_ids):
+    results = {}
+    for ids in doc_ids:
+        for doc_id in ids:
+            lines = db.get_doc_lines(doc_id)
+            if lines is not None:
+                results[doc_id] = lines
+    return results
+
+
+def run_bulk(db, doc_ids, batch_size):
+    results = {}
+    for i in range(0, len(doc_ids), batch_size):
+        batch = set(doc_id for ids in doc_ids[i : i + batch_size] for doc_id in ids)
+        results.update(db.get_docs_lines(batch))
+    return results
+
+
+def build_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_file", type=str, required=True)
+    parser.add_argument(
+        "--immutable_db",
+        action="store_true",
+        help="open db_file as immutable; nothing may write it meanwhile",
+    )
+    parser.add_argument("--in_file", type=str, required=True)
+    parser.add_argument("--max_claims", type=int, default=10000)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=3435)
+    return parser.parse_args()
+
+
+def main():
+    args = build_args()
+    random.seed(args.seed)
+
+    doc_ids = get_doc_ids(args.in_file, args.max_claims)
+    random.shuffle(doc_ids)
+    num_lookups = sum(len(ids) for ids in doc_ids)
+    print(f"{len(doc_ids)} claims, {num_lookups} lookups")
+
+    timings = {}
+    outputs = {}
+    with FeverDocDB(args.db_file, immutable=args.immutable_db) as db:
+        for name, fn in [
+            ("per-id", lambda: run_per_id(db, doc_ids)),
+            ("bulk", lambda: run_bulk(db, doc_ids, args.batch_size)),
+        ]:
+            t_start = time.perf_counter()
+            outputs[name] = fn()
+            timings[name] = time.perf_counter() - t_start
+            print(
+                f"{name:>8}: {timings[name]:.3f}s "
+                f"({num_lookups / timings[name]:.0f} lookups/s)"
+            )
+
+    assert outputs["per-id"] == outputs["bulk"]
+    print(f"Speedup: {timings['per-id'] / timings['bulk']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import argparse
+import re
+import time
+import unicodedata
+from transformers.data.processors.utils import DataProcessor
+import normalization
+
+
+# The uncompiled versions that normalization.py replaces
+def reference_process_claim(text):
+    text = unicodedata.normalize("NFD", text)
+    text = re.sub(r" \-LSB\-.*?\-RSB\-", "", text)
+    text = re.sub(r"\-LRB\- \-RRB\- ", "", text)
+    text = re.sub(" -LRB-", " ( ", text)
+    text = re.sub("-RRB-", " )", text)
+    text = re.sub("--", "-", text)
+    text = re.sub("``", '"', text)
+    text = re.sub("''", '"', text)
+    return text
+
+
+def reference_process_title(text):
+    text = unicodedata.normalize("NFD", text)
+    text = re.sub("_", " ", text)
+    text = re.sub(" -LRB-", " ( ", text)
+    text = re.sub("-RRB-", " )", text)
+    text = re.sub("-COLON-", ":", text)
+    return text
+
+
+def reference_process_sentence(text):
+    text = unicodedata.normalize("NFD", text)
+    text = re.sub(" -LSB-.*-RSB-", " ", text)
+    text = re.sub(" -LRB- -RRB- ", " ", text)
+    text = re.sub("-LRB-", "(", text)
+    text = re.sub("-RRB-", ")", text)
+    text = re.sub("-COLON-", ":", text)
+    text = re.sub("_", " ", text)
+    text = re.sub(r"\( *\,? *\)", "", text)
+    text = re.sub(r"\( *[;,]", "(", text)
+    text = re.sub("--", "-", text)
+    text = re.sub("``", '"', text)
+    text = re.sub("''", '"', text)
+    return text
+
+
+def normalize_lines(lines, process_claim, process_title, process_sentence):
+    outputs = []
+    for line in lines:
+        text_a = process_claim(line[1])
+        text_b = None
+        if int(line[3]) != -1:
+            text_b = f"{process_title(line[2])} : {process_sentence(line[4])}"
+        outputs.append((text_a, text_b))
+    return outputs
+
+
+def build_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--in_file", type=str, required=True)
+    parser.add_argument("--max_lines", type=int, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = build_args()
+
+    lines = DataProcessor._read_tsv(args.in_file)[: args.max_lines]
+    print(f"{len(lines)} lines")
+
+    timings = {}
+    outputs = {}
+    for name, fns in [
+        (
+            "reference",
+            (
+                reference_process_claim,
+                reference_process_title,
+                reference_process_sentence,
+            ),
+        ),
+        (
+            "compiled",
+            (
+                normalization.process_claim,
+                normalization.process_title,
+                normalization.process_sentence,
+            ),
+        ),
+    ]:
+        t_start = time.perf_counter()
+        outputs[name] = normalize_lines(lines, *fns)
+        timings[name] = time.perf_counter() - t_start
+        print(
+            f"{name:>9}: {timings[name]:.3f}s "
+            f"({len(lines) / timings[name]:.0f} lines/s)"
+        )
+
+    assert outputs["reference"] == outputs["compiled"]
+    print(f"Speedup: {timings['reference'] / timings['compiled']:.2f}x")
+    for fn in [
+        normalization.process_claim,
+        normalization.process_title,
+        normalization.process_sentence,
+    ]:
+        print(f"{fn.__name__}: {fn.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import argparse
+import numpy as np
+from itertools import islice
+import time
+from transformers import AutoTokenizer
+from processors import (
+    fc_processors,
+    convert_examples_to_arrays,
+    convert_examples_to_features,
+)
+
+
+def build_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--in_file", type=str, required=True)
+    parser.add_argument("--task", type=str, default="sentence-selection")
+    parser.add_argument(
+        "--pretrained_model_name", type=str, default="bert-base-uncased"
+    )
+    parser.add_argument("--max_seq_length", type=int, default=128)
+    parser.add_argument("--max_examples", type=int, default=None)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=1024)
+    parser.add_argument("--training", action="store_true")
+    parser.add_argument("--use_title", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = build_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.pretrained_model_name, use_fast=True)
+    processor = fc_processors[args.task]()
+    examples = list(
+        islice(
+            processor.get_examples(args.in_file, "test", args.training, args.use_title),
+            args.max_examples,
+        )
+    )
+    print(f"{len(examples)} examples")
+
+    # Run the batched path first: forking the pool afterwards would disable
+    # the tokenizer's own parallelism
+    t_start = time.perf_counter()
+    arrays = convert_examples_to_arrays(
+        examples,
+        tokenizer,
+        max_length=args.max_seq_length,
+        task=args.task,
+        batch_size=args.batch_size,
+    )
+    t_batch = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    features = convert_examples_to_features(
+        examples,
+        tokenizer,
+        max_length=args.max_seq_length,
+        task=args.task,
+        threads=args.num_workers,
+    )
+    t_pool = time.perf_counter() - t_start
+
+    for k in ["input_ids", "attention_mask", "token_type_ids"]:
+        if k in arrays:
+            assert np.array_equal(
+                np.array([getattr(f, k) for f in features]), arrays[k]
+            )
+
+    for name, t in [("pool", t_pool), ("batched", t_batch)]:
+        print(f"{name:>8}: {t:.3f}s ({len(examples) / t:.0f} examples/s)")
+    print(f"Speedup: {t_pool / t_batch:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import argparse
+import time
+import torch
+from bench_attention import read_status, reset_peak_rss
+from modeling_verification import VerificationModel
+
+
+def build_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--pretrained_model_name", type=str, default="bert-base-uncased"
+    )
+    parser.add_argument("--max_seq_length", type=int, default=128)
+    parser.add_argument("--num_evidence", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--attn_backend", type=str, default="reference")
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def measure(args, model, num_evidence):
+    # encoder outputs of claims with evidence of random lengths
+    num_rows = args.batch_size * (num_evidence + 1)
+    hidden_states = torch.randn(num_rows, args.max_seq_length, model.config.hidden_size)
+    lengths = torch.randint(8, args.max_seq_length + 1, (num_rows, 1))
+    attention_mask = (torch.arange(args.max_seq_length) < lengths).long()
+    attention_mask = attention_mask.view(args.batch_size, num_evidence + 1, -1)
+
+    with torch.no_grad():
+        rss_start = reset_peak_rss()
+        model.word_attention(hidden_states, attention_mask)
+        rss_peak = read_status("VmHWM") - rss_start
+
+        t_start = time.perf_counter()
+        for _ in range(args.repeat):
+            model.word_attention(hidden_states, attention_mask)
+        t_step = (time.perf_counter() - t_start) / args.repeat
+    return t_step, rss_peak / 1024
+
+
+def main():
+    args = build_args()
+
+    print(f"batch {args.batch_size}, max_seq_length {args.max_seq_length}")
+    for num_evidence in args.num_evidence:
+        for mode in ["dense", "sparse"]:
+            hparams = argparse.Namespace(
+                pretrained_model_name=args.pretrained_model_name,
+                num_evidence=num_evidence,
+                max_seq_length=args.max_seq_length,
+                aggregate_mode="mean",
+                attn_bias_type="none",
+                attn_backend=args.attn_backend,
+                word_attn=True,
+                word_attn_mode=mode,
+                sent_attn=False,
+                classifier_dropout_prob=0.1,
+            )
+            model = VerificationModel(hparams, num_labels=3).eval()
+            torch.manual_seed(0)
+            t_step, peak_mb = measure(args, model, num_evidence)
+            print(
+                f"evidence {num_evidence:3d} {mode:>6}: {t_step * 1000:8.1f} ms, "
+                f"peak +{peak_mb:7.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
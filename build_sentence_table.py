@@ -0,0 +1,60 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import argparse
+from tqdm import tqdm
+from fever_doc_db import FeverDocDB, parse_doc_lines
+
+
+def build_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_file", type=str, required=True)
+    parser.add_argument("--batch_size", type=int, default=10000)
+    return parser.parse_args()
+
+
+def main():
+    args = build_args()
+
+    with FeverDocDB(args.db_file, read_only=False) as db:
+        connection = db.connection
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("DROP TABLE IF EXISTS sentences")
+        connection.execute(
+            "CREATE TABLE sentences ("
+            "doc_id TEXT NOT NULL, "
+            "sent_id INTEGER NOT NULL, "
+            "text TEXT NOT NULL, "
+            "PRIMARY KEY (doc_id, sent_id)"
+            ") WITHOUT ROWID"
+        )
+        (num_docs,) = connection.execute("SELECT COUNT(*) FROM documents").fetchone()
+
+        def insert(sents):
+            connection.executemany("INSERT INTO sentences VALUES (?, ?, ?)", sents)
+            connection.commit()
+
+        num_sents = 0
+        sents = []
+        for doc_id, lines in tqdm(
+            db.iter_docs(batch_size=args.batch_size),
+            total=num_docs,
+            desc="Building sentences",
+        ):
+            if lines:
+                for sent_id, sent_text in parse_doc_lines(lines):
+                    sents.append((doc_id, sent_id, sent_text))
+            if len(sents) >= args.batch_size:
+                insert(sents)
+                num_sents += len(sents)
+                sents = []
+        insert(sents)
+        num_sents += len(sents)
+
+    print(f"Save {num_sents} sentences to '{args.db_file}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import argparse
+import json
+from tqdm import tqdm
+from fever_corpus import CorpusWriter
+from fever_doc_db import FeverDocDB, parse_doc_lines
+
+
+def iter_jsonl_docs(file_path):
+    # Index the lines first so that we can write them sorted by doc_id
+    # without holding the parsed documents in memory
+    offsets = []
+    with open(file_path, "rb") as f:
+        offset = f.tell()
+        for line in iter(f.readline, b""):
+            offsets.append((json.loads(line)["doc_id"].encode("utf-8"), offset))
+            offset = f.tell()
+        offsets.sort()
+        for _, offset in offsets:
+            f.seek(offset)
+            doc = json.loads(f.readline())
+            yield doc["doc_id"], doc["lines"]
+
+
+def iter_db_docs(db_file, immutable=False):
+    with FeverDocDB(db_file, immutable=immutable) as db:
+        cursor = db.connection.cursor()
+        cursor.execute("SELECT id, lines FROM documents ORDER BY id")
+        for doc_id, lines in cursor:
+            if lines:
+                yield doc_id, parse_doc_lines(lines)
+        cursor.close()
+
+
+def build_args():
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--corpus", type=str)
+    group.add_argument("--db_file", type=str)
+    parser.add_argument(
+        "--immutable_db",
+        action="store_true",
+        help="open db_file as immutable; nothing may write it meanwhile",
+    )
+    parser.add_argument("--out_dir", type=str, required=True)
+    return parser.parse_args()
+
+
+def main():
+    args = build_args()
+
+    if args.db_file is not None:
+        # fever.db stores NFD-normalized ids, so normalize lookups the same way
+        docs, normalize = iter_db_docs(args.db_file, args.immutable_db), "NFD"
+    else:
+        docs, normalize = iter_jsonl_docs(args.corpus), None
+
+    with CorpusWriter(args.out_dir, normalize=normalize) as writer:
+        for doc_id, lines in tqdm(docs, desc="Converting documents"):
+            writer.add(doc_id, lines)
+
+    print(f"Save to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -21,15 +21,16 @@ if [[ ! -d "${doc_dir}" ]]; then
   mv 'test.wiki7.jsonl' "${doc_dir}/shared_task_test.jsonl"
 fi
 
+# To add the pages of a new document retrieval output to an existing
+# corpus.jsonl, run preprocess_corpus.py with --update
 if [[ ! -f 'corpus.jsonl' ]]; then
-  for split in 'train' 'shared_task_dev' 'shared_task_test'; do
-    python '../../preprocess_corpus.py' \
-      --db_file 'fever.db' \
-      --in_file "${doc_dir}/${split}.jsonl" \
-      --out_file "tmp_${split}.jsonl"
-  done
-  cat tmp_*.jsonl | sort | uniq > 'corpus.jsonl'
-  rm -f tmp_*.jsonl
+  python '../../preprocess_corpus.py' \
+    --db_file 'fever.db' \
+    --immutable_db \
+    --in_file "${doc_dir}/train.jsonl" \
+      "${doc_dir}/shared_task_dev.jsonl" \
+      "${doc_dir}/shared_task_test.jsonl" \
+    --out_file 'corpus.jsonl'
   wc -l 'corpus.jsonl'
 fi
 
@@ -0,0 +1,135 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from feature_utils import MANIFEST_FILE, is_feature_store
+
+FEATURE_VERSION = 3  # bump when the feature layout changes
+
+
+def file_digest(file_path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def feature_fingerprint(file_path, **params):
+    """Key of the features built from the content of `file_path` with `params`."""
+    key = {
+        "version": FEATURE_VERSION,
+        "source": file_digest(file_path),
+        "params": params,
+    }
+    data = json.dumps(key, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def touch(path):
+    # the manifest's mtime is the last use of an entry; a shared cache may be
+    # read-only (or the entry being replaced), and then the entry keeps its age
+    try:
+        os.utime(Path(path) / MANIFEST_FILE)
+    except OSError:
+        pass
+
+
+def dir_size(path):
+    return sum(f.stat().st_size for f in Path(path).iterdir() if f.is_file())
+
+
+def list_entries(cache_dir):
+    entries = []
+    for path in sorted(Path(cache_dir).iterdir()):
+        if not is_feature_store(path):
+            continue
+        with open(path / MANIFEST_FILE, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        entries.append(
+            {
+                "path": path,
+                "last_used": (path / MANIFEST_FILE).stat().st_mtime,
+                "size": dir_size(path),
+                "num_rows": manifest["num_rows"],
+                "meta": manifest.get("meta", {}),
+            }
+        )
+    return entries
+
+
+def collect_garbage(cache_dir, max_age_days=None, max_size_gb=None, dry_run=False):
+    """Remove entries unused for `max_age_days`, then the least recently used
+    ones until the cache fits in `max_size_gb`."""
+    entries = sorted(list_entries(cache_dir), key=lambda e: e["last_used"])
+    removed = []
+    if max_age_days is not None:
+        deadline = datetime.datetime.now().timestamp() - max_age_days * 86400
+        removed += [e for e in entries if e["last_used"] < deadline]
+        entries = [e for e in entries if e["last_used"] >= deadline]
+    if max_size_gb is not None:
+        total_size = sum(e["size"] for e in entries)
+        while entries and total_size > max_size_gb * (1 << 30):
+            entry = entries.pop(0)
+            total_size -= entry["size"]
+            removed.append(entry)
+
+    # half-written or replaced entries left by interrupted runs (not the ones
+    # being written)
+    deadline = datetime.datetime.now().timestamp() - 86400
+    for pattern in ["*.tmp*", "*.old*"]:
+        for path in Path(cache_dir).glob(pattern):
+            if path.stat().st_mtime < deadline:
+                removed.append({"path": path, "size": dir_size(path)})
+
+    for entry in removed:
+        print(f"Remove '{entry['path']}' ({entry['size'] / (1 << 20):.1f} MB)")
+        if not dry_run:
+            shutil.rmtree(entry["path"])
+    return removed
+
+
+def build_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["list", "gc"])
+    parser.add_argument("--cache_dir", type=str, required=True)
+    parser.add_argument("--max_age_days", type=float, default=None)
+    parser.add_argument("--max_size_gb", type=float, default=None)
+    parser.add_argument("--dry_run", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = build_args()
+
+    if args.command == "list":
+        total_size = 0
+        for entry in list_entries(args.cache_dir):
+            last_used = datetime.datetime.fromtimestamp(entry["last_used"])
+            meta = entry["meta"]
+            print(
+                f"{entry['path'].name}  {last_used:%Y-%m-%d %H:%M}  "
+                f"{entry['size'] / (1 << 20):8.1f} MB  {entry['num_rows']:8d} rows  "
+                f"{meta.get('source_file', '')}  {json.dumps(meta.get('params', {}))}"
+            )
+            total_size += entry["size"]
+        print(f"Total: {total_size / (1 << 30):.2f} GB")
+    else:
+        removed = collect_garbage(
+            args.cache_dir,
+            max_age_days=args.max_age_days,
+            max_size_gb=args.max_size_gb,
+            dry_run=args.dry_run,
+        )
+        print(f"Removed {len(removed)} entries")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import json
+import jsonlines
+import mmap
+import numpy as np
+import unicodedata
+from array import array
+from collections.abc import Mapping
+from pathlib import Path
+
+META_FILE = "meta.json"
+DOC_IDS_FILE = "doc_ids.bin"
+TEXTS_FILE = "texts.bin"
+ARRAY_FILES = {
+    "doc_id_offsets": "doc_id_offsets.npy",  # num_docs + 1, into doc_ids.bin
+    "sent_offsets": "sent_offsets.npy",  # num_docs + 1, into sent_ids
+    "sent_ids": "sent_ids.npy",  # num_sents
+    "text_offsets": "text_offsets.npy",  # num_sents + 1, into texts.bin
+}
+
+
+def load_corpus(path):
+    """Load a corpus.jsonl file as a dict or open a corpus directory as MmapCorpus."""
+    if Path(path).is_dir():
+        return MmapCorpus(path)
+    return {doc["doc_id"]: doc for doc in jsonlines.open(path)}
+
+
+def _open_blob(path):
+    with open(path, "rb") as f:
+        if Path(path).stat().st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class MmapCorpus(Mapping):
+    """Read-only, memory-mapped corpus written by CorpusWriter.
+
+    Behaves like the dict loaded from corpus.jsonl, i.e., corpus[doc_id]
+    returns {"doc_id": doc_id, "lines": [[sent_id, sent_text], ...]}, but
+    documents are decoded on demand and all processes opening the same
+    directory share the OS page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        path = Path(path)
+        with open(path / META_FILE, "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.normalize = self.meta["normalize"]
+        for name, file_name in ARRAY_FILES.items():
+            setattr(self, name, np.load(path / file_name, mmap_mode="r"))
+        self.doc_ids = _open_blob(path / DOC_IDS_FILE)
+        self.texts = _open_blob(path / TEXTS_FILE)
+
+    def __reduce__(self):
+        # Reopen the maps instead of pickling them, e.g., for Pool workers
+        return (self.__class__, (self.path,))
+
+    def __len__(self):
+        return self.meta["num_docs"]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._doc_id(i).decode("utf-8")
+
+    def __contains__(self, doc_id):
+        return self._find(doc_id) >= 0
+
+    def __getitem__(self, doc_id):
+        i = self._find(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return {"doc_id": doc_id, "lines": self._lines(i)}
+
+    def _doc_id(self, i):
+        start, end = self.doc_id_offsets[i], self.doc_id_offsets[i + 1]
+        return self.doc_ids[start:end]
+
+    def _find(self, doc_id):
+        if not isinstance(doc_id, str):  # e.g., None in evidence of NEI claims
+            return -1
+        if self.normalize is not None:
+            doc_id = unicodedata.normalize(self.normalize, doc_id)
+        key = doc_id.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._doc_id(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._doc_id(lo) == key:
+            return lo
+        return -1
+
+    def _lines(self, i):
+        start, end = self.sent_offsets[i], self.sent_offsets[i + 1]
+        sent_ids = self.sent_ids[start:end].tolist()
+        offsets = self.text_offsets[start : end + 1].tolist()
+        texts = self.texts[offsets[0] : offsets[-1]]
+        base = offsets[0]
+        return [
+            [sent_id, texts[s - base : e - base].decode("utf-8")]
+            for sent_id, s, e in zip(sent_ids, offsets[:-1], offsets[1:])
+        ]
+
+
+class CorpusWriter(object):
+    """Write documents in increasing doc_id order into a MmapCorpus directory."""
+
+    def __init__(self, path, normalize=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.normalize = normalize
+        self.doc_ids = open(self.path / DOC_IDS_FILE, "wb")
+        self.texts = open(self.path / TEXTS_FILE, "wb")
+        self.doc_id_offsets = array("q", [0])
+        self.sent_offsets = array("q", [0])
+        self.sent_ids = array("i")
+        self.text_offsets = array("q", [0])
+        self.last_doc_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, doc_id, lines):
+        if self.normalize is not None:
+            doc_id = unicodedata.normalize(self.normalize, doc_id)
+        key = doc_id.encode("utf-8")
+        if self.last_doc_id is not None and key <= self.last_doc_id:
+            raise ValueError(f"Documents are not sorted by doc_id at '{doc_id}'")
+        self.last_doc_id = key
+
+        self.doc_ids.write(key)
+        self.doc_id_offsets.append(self.doc_id_offsets[-1] + len(key))
+        for sent_id, sent_text in lines:
+            text = sent_text.encode("utf-8")
+            self.texts.write(text)
+            self.sent_ids.append(sent_id)
+            self.text_offsets.append(self.text_offsets[-1] + len(text))
+        self.sent_offsets.append(len(self.sent_ids))
+
+    def close(self):
+        self.doc_ids.close()
+        self.texts.close()
+        arrays = {
+            "doc_id_offsets": np.frombuffer(self.doc_id_offsets, dtype=np.int64),
+            "sent_offsets": np.frombuffer(self.sent_offsets, dtype=np.int64),
+            "sent_ids": np.frombuffer(self.sent_ids, dtype=np.int32),
+            "text_offsets": np.frombuffer(self.text_offsets, dtype=np.int64),
+        }
+        for name, file_name in ARRAY_FILES.items():
+            np.save(self.path / file_name, arrays[name])
+        meta = {
+            "num_docs": len(self.doc_id_offsets) - 1,
+            "num_sents": len(self.sent_ids),
+            "normalize": self.normalize,
+        }
+        with open(self.path / META_FILE, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
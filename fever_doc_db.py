@@ -6,16 +6,51 @@
 # Additional license and copyright information for this source code are available at:
 # https://github.com/facebookresearch/DrQA/blob/master/LICENSE
 
+import re
 import sqlite3
+import sys
 import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+MAX_VARIABLES = 999  # SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+MMAP_SIZE = 1 << 34  # sqlite clamps this to its compile-time maximum
+CACHE_SIZE = -65536  # in KiB when negative, i.e., 64 MiB per connection
+
+
+def parse_doc_lines(lines):
+    """Split the raw 'lines' of a doc into [[sent_id, sent_text], ...]."""
+    sents = []
+    lines = re.split(r"\n(?=\d+)", lines)
+    for line in lines:
+        line = line.split("\t")
+        if len(line) < 2:
+            continue
+        sent_id = int(line[0])
+        sent_text = unicodedata.normalize("NFD", line[1].strip())
+        if not len(sent_text):
+            continue
+        sents.append([sent_id, sent_text])
+    return sents
 
 
 class FeverDocDB(object):
     """Sqlite backed document storage."""
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, read_only=True, immutable=False):
         self.path = db_path
-        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        if read_only:
+            # With 'immutable', sqlite skips locking and change detection, which
+            # is only safe if no other process writes the db while it is open
+            # (e.g., build_sentence_table.py)
+            uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+            if immutable:
+                uri += "&immutable=1"
+            self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self.connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+            self.connection.execute(f"PRAGMA cache_size = {CACHE_SIZE}")
+        else:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
 
     def __enter__(self):
         return self
@@ -31,6 +66,24 @@ class FeverDocDB(object):
         """Close the connection to the database."""
         self.connection.close()
 
+    def has_table(self, name):
+        """Whether the db has the table 'name', e.g., sentences."""
+        cursor = self.connection.cursor()
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+        )
+        result = cursor.fetchone()
+        cursor.close()
+        return result is not None
+
+    def get_columns(self, table):
+        """Fetch the names of the columns of the table 'table'."""
+        cursor = self.connection.cursor()
+        cursor.execute(f"PRAGMA table_info({table})")
+        results = [r[1] for r in cursor.fetchall()]
+        cursor.close()
+        return results
+
     def get_doc_ids(self):
         """Fetch all ids of docs stored in the db."""
         cursor = self.connection.cursor()
@@ -39,6 +92,46 @@ class FeverDocDB(object):
         cursor.close()
         return results
 
+    def iter_docs(
+        self, batch_size=1000, columns=("id", "lines"), shard=0, num_shards=1
+    ):
+        """Iterate over the rows of the documents table in rowid order.
+
+        Rows are fetched 'batch_size' at a time and yielded as tuples of
+        'columns'. With 'num_shards' > 1, only the 'shard'-th of 'num_shards'
+        contiguous rowid ranges is scanned, so workers can split the table.
+        """
+        if not 0 <= shard < num_shards:
+            raise ValueError(f"Invalid shard {shard} of {num_shards}")
+        doc_columns = self.get_columns("documents")
+        for column in columns:
+            if column not in doc_columns:
+                raise ValueError(f"Unknown column '{column}' of table documents")
+
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT MIN(rowid), MAX(rowid) FROM documents")
+        min_rowid, max_rowid = cursor.fetchone()
+        if min_rowid is None:
+            cursor.close()
+            return
+
+        span = max_rowid - min_rowid + 1
+        start = min_rowid + span * shard // num_shards
+        end = min_rowid + span * (shard + 1) // num_shards
+        query = (
+            f"SELECT rowid, {', '.join(columns)} FROM documents "
+            "WHERE rowid >= ? AND rowid < ? ORDER BY rowid LIMIT ?"
+        )
+        while start < end:
+            cursor.execute(query, (start, end, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row[1:]
+            start = rows[-1][0] + 1
+        cursor.close()
+
     def get_doc_lines(self, doc_id):
         """Fetch the raw text of the doc for 'doc_id'."""
         cursor = self.connection.cursor()
@@ -50,3 +143,154 @@ class FeverDocDB(object):
         result = cursor.fetchone()
         cursor.close()
         return result if result is None else result[0]
+
+    def get_docs_lines(self, doc_ids):
+        """Fetch the raw text of the docs for 'doc_ids' with a few IN queries.
+
+        Return a dict keyed by the given (unnormalized) ids. Ids that are not
+        found in the db are left out.
+        """
+        norm_ids = {}
+        for doc_id in doc_ids:
+            norm_id = unicodedata.normalize("NFD", doc_id)
+            norm_ids.setdefault(norm_id, []).append(doc_id)
+
+        results = {}
+        keys = list(norm_ids)
+        cursor = self.connection.cursor()
+        for i in range(0, len(keys), MAX_VARIABLES):
+            chunk = keys[i : i + MAX_VARIABLES]
+            placeholders = ", ".join(["?"] * len(chunk))
+            cursor.execute(
+                f"SELECT id, lines FROM documents WHERE id IN ({placeholders})",
+                chunk,
+            )
+            for norm_id, lines in cursor:
+                for doc_id in norm_ids[norm_id]:
+                    results[doc_id] = lines
+        cursor.close()
+        return results
+
+    def get_sentence(self, doc_id, sent_id):
+        """Fetch the text of sentence 'sent_id' of the doc for 'doc_id'.
+
+        Requires the sentences table created by build_sentence_table.py.
+        """
+        return self.get_sentences([(doc_id, sent_id)]).get((doc_id, sent_id))
+
+    def get_sentences(self, pairs):
+        """Fetch the texts of the (doc_id, sent_id) 'pairs' with a few queries.
+
+        Return a dict keyed by the given (unnormalized) pairs. Pairs that are
+        not found in the sentences table are left out.
+        """
+        norm_pairs = {}
+        for doc_id, sent_id in pairs:
+            norm_pair = (unicodedata.normalize("NFD", doc_id), sent_id)
+            norm_pairs.setdefault(norm_pair, []).append((doc_id, sent_id))
+
+        results = {}
+        keys = list(norm_pairs)
+        chunk_size = MAX_VARIABLES // 2
+        cursor = self.connection.cursor()
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i : i + chunk_size]
+            placeholders = ", ".join(["(?, ?)"] * len(chunk))
+            # a join lets sqlite search the primary key once per pair
+            cursor.execute(
+                "SELECT s.doc_id, s.sent_id, s.text "
+                f"FROM (VALUES {placeholders}) AS v JOIN sentences AS s "
+                "ON s.doc_id = v.column1 AND s.sent_id = v.column2",
+                [x for pair in chunk for x in pair],
+            )
+            for norm_id, sent_id, text in cursor:
+                for pair in norm_pairs[(norm_id, sent_id)]:
+                    results[pair] = text
+        cursor.close()
+        return results
+
+
+class CachedFeverDocDB(object):
+    """LRU cache of parsed docs in front of a FeverDocDB.
+
+    Entries are evicted once there are more than 'max_docs' of them or their
+    sentences take more than 'max_bytes'. Docs that are missing or empty in
+    the db are cached as None.
+    """
+
+    def __init__(self, db, max_docs=None, max_bytes=None):
+        self.db = db
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the underlying db."""
+        self.db.close()
+
+    def stats(self):
+        """Return the hit/miss/eviction counters and the current cache size."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "docs": len(self.cache),
+            "bytes": self.num_bytes,
+        }
+
+    @staticmethod
+    def _size(sents):
+        if sents is None:
+            return 0
+        return sum(sys.getsizeof(sent_text) for _, sent_text in sents)
+
+    def _put(self, doc_id, sents):
+        self.cache[doc_id] = sents
+        self.num_bytes += self._size(sents)
+        while self.cache and (
+            (self.max_docs is not None and len(self.cache) > self.max_docs)
+            or (self.max_bytes is not None and self.num_bytes > self.max_bytes)
+        ):
+            _, evicted = self.cache.popitem(last=False)
+            self.num_bytes -= self._size(evicted)
+            self.evictions += 1
+
+    def get_doc_sentences(self, doc_id):
+        """Fetch the parsed sentences of the doc for 'doc_id'."""
+        return self.get_docs_sentences([doc_id])[doc_id]
+
+    def get_docs_sentences(self, doc_ids):
+        """Fetch the parsed sentences of the docs for 'doc_ids'.
+
+        Return a dict keyed by the given ids. Missing or empty docs map to None.
+        """
+        results = {}
+        missing = []
+        for doc_id in doc_ids:
+            if doc_id in self.cache:
+                self.cache.move_to_end(doc_id)
+                results[doc_id] = self.cache[doc_id]
+                self.hits += 1
+            elif doc_id not in results:
+                missing.append(doc_id)
+                results[doc_id] = None
+                self.misses += 1
+
+        if missing:
+            docs_lines = self.db.get_docs_lines(missing)
+            for doc_id in missing:
+                lines = docs_lines.get(doc_id)
+                sents = parse_doc_lines(lines) if lines else None
+                results[doc_id] = sents
+                self._put(doc_id, sents)
+        return results
@@ -30,6 +30,8 @@ arg_to_scheduler = {
 
 
 class BaseTransformer(pl.LightningModule):
+    replace_sampler_ddp = True
+
     def __init__(
         self,
         hparams,
@@ -88,7 +90,9 @@ class BaseTransformer(pl.LightningModule):
                 * self.hparams.accumulate_grad_batches
                 * num_devices
             )
-            dataset_size = len(self.train_loader.dataset)
+            dataset = self.train_loader.dataset
+            # streamed datasets have a length in batches
+            dataset_size = getattr(dataset, "num_rows", None) or len(dataset)
             self.total_steps = (
                 dataset_size / effective_batch_size
             ) * self.hparams.max_epochs
@@ -132,7 +136,7 @@ class BaseTransformer(pl.LightningModule):
                 "params": [
                     p
                     for n, p in model.named_parameters()
-                    if not any(nd in n for nd in no_decay)
+                    if p.requires_grad and not any(nd in n for nd in no_decay)
                 ],
                 "weight_decay": self.hparams.weight_decay,
             },
@@ -140,7 +144,7 @@ class BaseTransformer(pl.LightningModule):
                 "params": [
                     p
                     for n, p in model.named_parameters()
-                    if any(nd in n for nd in no_decay)
+                    if p.requires_grad and any(nd in n for nd in no_decay)
                 ],
                 "weight_decay": 0.0,
             },
@@ -189,6 +193,7 @@ def generic_train(model, args, callbacks):
 
     if args.gpus > 1:
         train_params["distributed_backend"] = "ddp"
+        train_params["replace_sampler_ddp"] = model.replace_sampler_ddp
 
     trainer = pl.Trainer.from_argparse_args(
         args,
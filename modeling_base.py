@@ -5,7 +5,13 @@
 from torch.nn import CrossEntropyLoss
 from transformers import AutoConfig, AutoModel
 from transformers.modeling_utils import PreTrainedModel
-from modeling_utils import Classifier
+from transformers.modeling_outputs import BaseModelOutput
+from modeling_utils import (
+    Classifier,
+    enable_gradient_checkpointing,
+    encode_layers,
+    encode_prefix,
+)
 
 
 class BaseModel(PreTrainedModel):
@@ -24,6 +30,18 @@ class BaseModel(PreTrainedModel):
         self.classifier = Classifier(
             self.config.hidden_size, num_labels, dropout=hparams.classifier_dropout_prob
         )
+        if getattr(hparams, "gradient_checkpointing", False):
+            enable_gradient_checkpointing(getattr(self, self.config.model_type))
+        self.freeze_layers = getattr(hparams, "freeze_layers", 0)
+
+    def encode_prefix(self, input_ids, attention_mask, token_type_ids=None):
+        return encode_prefix(
+            getattr(self, self.config.model_type),
+            input_ids,
+            attention_mask,
+            token_type_ids,
+            self.freeze_layers,
+        )
 
     def forward(
         self,
@@ -37,20 +55,34 @@ class BaseModel(PreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        prefix_hidden_states=None,
     ):
         assert input_ids.dim() == 2  # batch x len
 
-        encoder_outputs = getattr(self, self.config.model_type)(
-            input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=True,
-        )
+        encoder = getattr(self, self.config.model_type)
+        if prefix_hidden_states is not None:
+            # the output of the frozen layers (see encode_prefix)
+            encoder_outputs = BaseModelOutput(
+                last_hidden_state=encode_layers(
+                    encoder,
+                    prefix_hidden_states,
+                    attention_mask,
+                    start=self.freeze_layers,
+                    head_mask=head_mask,
+                )
+            )
+        else:
+            encoder_outputs = encoder(
+                input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=True,
+            )
 
         features = encoder_outputs.last_hidden_state[:, 0]  # equiv. to [CLS]
 
@@ -5,6 +5,112 @@
 import math
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+
+def encoder_layers(encoder):
+    """The layers of a BERT-like encoder (e.g., BERT, RoBERTa, ELECTRA).
+
+    Other layouts are not supported, e.g., ALBERT, whose layers share their
+    parameters.
+    """
+    layers = getattr(getattr(encoder, "encoder", None), "layer", None)
+    if not hasattr(encoder, "embeddings") or not isinstance(layers, nn.ModuleList):
+        raise ValueError(
+            f"'{encoder.config.model_type}' does not have the layers of a "
+            "BERT-like encoder (embeddings, encoder.layer)"
+        )
+    return layers
+
+
+def frozen_modules(encoder, num_layers):
+    """The embeddings and the bottom `num_layers` layers of an encoder."""
+    layers = encoder_layers(encoder)
+    if num_layers > len(layers):
+        raise ValueError(f"Cannot freeze {num_layers} of {len(layers)} layers")
+    return [encoder.embeddings] + list(layers[:num_layers])
+
+
+def disable_dropout(module):
+    for m in module.modules():
+        if isinstance(m, nn.Dropout):
+            m.p = 0.0
+
+
+def encode_prefix(encoder, input_ids, attention_mask, token_type_ids, num_layers):
+    """Hidden states after the embeddings and the bottom `num_layers` layers.
+
+    These layers are frozen: they run without gradients and without dropout
+    (as in training with --freeze_layers), so their output for an input does
+    not change during training.
+    """
+    training = encoder.training
+    encoder.eval()
+    with torch.no_grad():
+        hidden_states = encoder.embeddings(
+            input_ids=input_ids, token_type_ids=token_type_ids
+        )
+        hidden_states = encode_layers(
+            encoder, hidden_states, attention_mask, end=num_layers
+        )
+    encoder.train(training)
+    return hidden_states
+
+
+def encode_layers(
+    encoder, hidden_states, attention_mask, start=0, end=None, head_mask=None
+):
+    """Run the layers [start, end) of a BERT-like encoder on `hidden_states`.
+
+    As in the forward of the encoder, `head_mask` is indexed by layer and the
+    layers are checkpointed if gradient checkpointing is enabled.
+    """
+    layers = encoder_layers(encoder)
+    extended_attention_mask = encoder.get_extended_attention_mask(
+        attention_mask, attention_mask.shape, attention_mask.device
+    )
+    head_mask = encoder.get_head_mask(head_mask, len(layers))
+    checkpointing = (
+        encoder.training
+        and torch.is_grad_enabled()
+        and (
+            getattr(encoder.config, "gradient_checkpointing", False)
+            or getattr(encoder.encoder, "gradient_checkpointing", False)
+        )
+    )
+    if checkpointing and not hidden_states.requires_grad:
+        # see enable_input_require_grads, e.g., for the output of encode_prefix
+        hidden_states = hidden_states.detach().requires_grad_()
+    for i in range(len(layers))[start:end]:
+        if checkpointing:
+            outputs = checkpoint(
+                layers[i], hidden_states, extended_attention_mask, head_mask[i]
+            )
+        else:
+            outputs = layers[i](hidden_states, extended_attention_mask, head_mask[i])
+        hidden_states = outputs[0]
+    return hidden_states
+
+
+def enable_gradient_checkpointing(encoder):
+    # transformers 4.3 reads the config, later versions need the method
+    encoder.config.gradient_checkpointing = True
+    if hasattr(encoder, "gradient_checkpointing_enable"):
+        encoder.gradient_checkpointing_enable()
+
+
+def enable_input_require_grads(encoder):
+    """Make the output of the embeddings of `encoder` require grad.
+
+    A (reentrant) checkpointed layer only backpropagates to its parameters if
+    its input requires grad, which is not the case above frozen embeddings.
+    """
+
+    def hook(module, inputs, output):
+        if torch.is_grad_enabled() and not output.requires_grad:
+            output.requires_grad_()
+
+    return encoder.embeddings.register_forward_hook(hook)
 
 
 class Classifier(nn.Module):
@@ -36,5 +142,8 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer("pe", pe)
 
-    def forward(self, x):
-        return x + self.pe
+    def forward(self, x, positions=None):
+        # x: batch x len x d_model, with len <= num_positions
+        if positions is None:
+            return x + self.pe[:, : x.size(1)]
+        return x + self.pe[:, positions]
@@ -7,14 +7,18 @@ from torch.nn import CrossEntropyLoss
 from pytorch_lightning.utilities import rank_zero_info
 from transformers import AutoConfig, AutoModel
 from transformers.modeling_utils import PreTrainedModel
-from transformers.modeling_outputs import SequenceClassifierOutput
+from transformers.modeling_outputs import BaseModelOutput, SequenceClassifierOutput
 from attentions import (
     MultiHeadedAttention,
     SelfAttention,
+    set_gradient_checkpointing,
 )
 from modeling_utils import (
     Classifier,
     PositionalEncoding,
+    enable_gradient_checkpointing,
+    encode_layers,
+    encode_prefix,
 )
 
 
@@ -32,6 +36,11 @@ class VerificationModel(PreTrainedModel):
         rank_zero_info(f"aggregate mode: {hparams.aggregate_mode}")
         self.attn_bias_type = hparams.attn_bias_type
         rank_zero_info(f"attention bias type: {hparams.attn_bias_type}")
+        self.skip_pad_evidence = getattr(hparams, "skip_pad_evidence", False)
+        self.freeze_layers = getattr(hparams, "freeze_layers", 0)
+        attn_backend = getattr(hparams, "attn_backend", "reference")
+        attn_chunk_size = getattr(hparams, "attn_chunk_size", 128)
+        rank_zero_info(f"attention backend: {attn_backend}")
 
         setattr(
             self,
@@ -52,54 +61,148 @@ class VerificationModel(PreTrainedModel):
 
         self.aggregate_attn = None
         if hparams.aggregate_mode == "attn":
-            self.aggregate_attn = MultiHeadedAttention(self.config, self.attn_bias_type)
+            self.aggregate_attn = MultiHeadedAttention(
+                self.config,
+                self.attn_bias_type,
+                backend=attn_backend,
+                chunk_size=attn_chunk_size,
+            )
 
         self.sent_attn = None
         if hparams.sent_attn:
-            self.sent_attn = SelfAttention(self.config)
+            self.sent_attn = SelfAttention(
+                self.config, backend=attn_backend, chunk_size=attn_chunk_size
+            )
             self.sent_position = PositionalEncoding(
                 self.num_evidence, self.config.hidden_size
             )
 
         self.word_attn = None
+        self.word_attn_mode = getattr(hparams, "word_attn_mode", "dense")
+        assert self.word_attn_mode in {"dense", "sparse"}
         if hparams.word_attn:
-            self.word_attn = SelfAttention(self.config)
+            rank_zero_info(f"word attention mode: {self.word_attn_mode}")
+            self.word_attn = SelfAttention(
+                self.config, backend=attn_backend, chunk_size=attn_chunk_size
+            )
             self.word_position = PositionalEncoding(
                 self.num_evidence * self.max_seq_length, self.config.hidden_size
             )
 
-    def get_logits(self, encoder_outputs, attention_mask=None, sent_scores=None):
-        # hidden_states: batch*(evidence+1) x len x hidden
-        # attention_mask: batch*(evidence+1) x len
-        # sent_scores: batch x evidence
-        num_evidence_plus = self.num_evidence + 1
-        hidden_states = encoder_outputs.last_hidden_state
-        hidden_size = self.config.hidden_size
+        if getattr(hparams, "gradient_checkpointing", False):
+            rank_zero_info("gradient checkpointing: encoder and attention layers")
+            enable_gradient_checkpointing(getattr(self, self.config.model_type))
+            set_gradient_checkpointing(self)
 
-        sents = None
-        if self.word_attn:
-            seq_length = self.num_evidence * self.max_seq_length
-            sent_hidden_states = hidden_states.view(
-                -1, num_evidence_plus, self.max_seq_length, self.config.hidden_size
-            )
-            sent_hidden_states = sent_hidden_states[:, 1:]  # skip claim
-            sent_hidden_states = sent_hidden_states.view(
-                -1, seq_length, self.config.hidden_size
-            )
-            sent_mask = attention_mask.view(-1, num_evidence_plus, self.max_seq_length)
-            sent_mask = sent_mask[:, 1:]  # skip claim
-            sent_mask = sent_mask.view(-1, seq_length)
+    def encode_prefix(self, input_ids, attention_mask, token_type_ids=None):
+        # input_ids: rows x len, with rows taken from batch*(evidence+1)
+        return encode_prefix(
+            getattr(self, self.config.model_type),
+            input_ids,
+            attention_mask,
+            token_type_ids,
+            self.freeze_layers,
+        )
 
-            sent_hidden_states = self.word_position(sent_hidden_states)
+    def word_positions(self, num_evidence, seq_length, device=None):
+        # token j of evidence e keeps position e * max_seq_length + j, as in
+        # batches padded to max_seq_length
+        positions = torch.arange(num_evidence, device=device) * self.max_seq_length
+        positions = positions.unsqueeze(1) + torch.arange(seq_length, device=device)
+        return positions.view(-1)
+
+    def word_attention(self, hidden_states, attention_mask, sent_mask=None):
+        """Attend over the words of the evidence and return their [CLS] states.
+
+        In the dense mode, every word attends to all the words of all the
+        evidence. In the sparse mode, the [CLS] of a sentence attends to the
+        words of its own sentence and to the global tokens: the [CLS] of the
+        other sentences and of the claim. Since get_logits only uses the [CLS]
+        states, the sparse mode computes them alone, in time linear in the
+        number of evidence.
+        """
+        num_evidence_plus, max_length = attention_mask.shape[1:]
+        num_evidence = num_evidence_plus - 1
+        seq_length = num_evidence * max_length
+        hidden_size = self.config.hidden_size
+        hidden_states = hidden_states.view(
+            -1, num_evidence_plus, max_length, hidden_size
+        )
+        sent_hidden_states = hidden_states[:, 1:]  # skip claim
+        sent_hidden_states = sent_hidden_states.reshape(-1, seq_length, hidden_size)
+        word_mask = attention_mask[:, 1:]  # skip claim
+        if sent_mask is not None:
+            word_mask = word_mask * sent_mask.unsqueeze(-1)
+
+        sent_hidden_states = self.word_position(
+            sent_hidden_states,
+            self.word_positions(num_evidence, max_length, hidden_states.device),
+        )
+
+        if self.word_attn_mode == "dense":
             sent_hidden_states = self.word_attn(
-                sent_hidden_states, sent_mask.unsqueeze(1)
+                sent_hidden_states, word_mask.reshape(-1, seq_length).unsqueeze(1)
             )
-
             # batch x evidence x len x hidden -> batch x evidence x hidden
             sent_hidden_states = sent_hidden_states.view(
-                -1, self.num_evidence, self.max_seq_length, self.config.hidden_size
+                -1, num_evidence, max_length, hidden_size
             )
-            sents = sent_hidden_states[:, :, 0]  # equiv. to [CLS]
+            return sent_hidden_states[:, :, 0]  # equiv. to [CLS]
+
+        # sents: batch x evidence x hidden
+        # global_states: batch x (evidence+1) x hidden
+        sent_hidden_states = sent_hidden_states.view(
+            -1, num_evidence, max_length, hidden_size
+        )
+        sents = sent_hidden_states[:, :, 0]  # equiv. to [CLS]
+        global_states = torch.cat([sents, hidden_states[:, 0, :1]], dim=1)
+        global_mask = word_mask.new_ones(global_states.shape[:2])
+        if sent_mask is not None:
+            global_mask[:, :num_evidence] = sent_mask
+        # a [CLS] is already among the words of its own sentence
+        global_mask = global_mask.unsqueeze(1) * (
+            1 - torch.eye(num_evidence, num_evidence_plus, dtype=global_mask.dtype)
+        ).to(global_mask.device)
+
+        # memory: batch*evidence x (len+evidence+1) x hidden
+        memory = torch.cat(
+            [
+                sent_hidden_states,
+                global_states.unsqueeze(1).expand(-1, num_evidence, -1, -1),
+            ],
+            dim=2,
+        )
+        memory_length = max_length + num_evidence_plus
+        memory = memory.view(-1, memory_length, hidden_size)
+        memory_mask = torch.cat([word_mask, global_mask], dim=2)
+        sents = self.word_attn(
+            sents.reshape(-1, 1, hidden_size),
+            memory_mask.view(-1, 1, memory_length),
+            memory=memory,
+        )
+        return sents.view(-1, num_evidence, hidden_size)
+
+    def get_logits(
+        self, encoder_outputs, attention_mask=None, sent_scores=None, evidence_mask=None
+    ):
+        # hidden_states: batch*(evidence+1) x len x hidden
+        # attention_mask: batch x (evidence+1) x len
+        # sent_scores: batch x evidence
+        # evidence_mask: batch x (evidence+1), False for [PAD] evidence
+        # evidence <= num_evidence and len <= max_seq_length may vary by batch
+        num_evidence_plus, max_length = attention_mask.shape[1:]
+        num_evidence = num_evidence_plus - 1
+        assert num_evidence <= self.num_evidence and max_length <= self.max_seq_length
+        hidden_states = encoder_outputs.last_hidden_state
+        hidden_size = self.config.hidden_size
+
+        sent_mask = None  # batch x evidence
+        if evidence_mask is not None:
+            sent_mask = evidence_mask[:, 1:]  # skip claim
+
+        sents = None
+        if self.word_attn:
+            sents = self.word_attention(hidden_states, attention_mask, sent_mask)
 
         # features: batch*(evidence+1) x hidden
         features = hidden_states[:, 0]  # equiv. to [CLS]
@@ -112,20 +215,31 @@ class VerificationModel(PreTrainedModel):
 
         if self.sent_attn:
             sents = self.sent_position(sents)
-            sents = self.sent_attn(sents)
+            sents = self.sent_attn(
+                sents, None if sent_mask is None else sent_mask.unsqueeze(1)
+            )
+
+        if sent_mask is not None:
+            sents = sents * sent_mask.unsqueeze(-1).to(sents.dtype)
 
         if self.aggregate_mode == "sum":
             aggregate_output = sents.sum(dim=1)
         elif self.aggregate_mode == "mean":
-            aggregate_output = sents.mean(dim=1)
+            if sent_mask is None:
+                aggregate_output = sents.mean(dim=1)
+            else:
+                num_sents = sent_mask.sum(dim=1, keepdim=True).clamp(min=1)
+                aggregate_output = sents.sum(dim=1) / num_sents.to(sents.dtype)
         elif self.aggregate_mode == "attn":
             aggregate_output = self.aggregate_attn(
                 claims,
                 sents,
                 sents,
+                mask=None if sent_mask is None else sent_mask.unsqueeze(1),
                 bias=sent_scores,
             ).squeeze(1)
         elif self.aggregate_mode == "concat":
+            assert num_evidence == self.num_evidence
             x = torch.cat([claims.unsqueeze(1), sents], dim=1)
             aggregate_output = x.view(x.size(0), -1)
 
@@ -154,24 +268,64 @@ class VerificationModel(PreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        evidence_mask=None,
+        prefix_hidden_states=None,
     ):
+        # prefix_hidden_states: batch*(evidence+1) x len x hidden
         assert input_ids.dim() == 3  # batch x evidence x len
-        input_ids = input_ids.view(-1, self.max_seq_length)
-        attention_mask = attention_mask.view(-1, self.max_seq_length)
+        max_length = input_ids.size(-1)
+        input_ids = input_ids.reshape(-1, max_length)
+        attention_mask = attention_mask.reshape(-1, max_length)
         if token_type_ids is not None:
-            token_type_ids = token_type_ids.view(-1, self.max_seq_length)
+            token_type_ids = token_type_ids.reshape(-1, max_length)
+
+        rows = None
+        if evidence_mask is not None:
+            # encode only the claim and real evidence rows
+            rows = evidence_mask.reshape(-1).nonzero(as_tuple=True)[0]
+            num_rows = input_ids.size(0)
+            input_ids = input_ids[rows]
+            attention_mask = attention_mask[rows]
+            if token_type_ids is not None:
+                token_type_ids = token_type_ids[rows]
+            if prefix_hidden_states is not None:
+                prefix_hidden_states = prefix_hidden_states[rows]
+
+        encoder = getattr(self, self.config.model_type)
+        if prefix_hidden_states is not None:
+            # the output of the frozen layers (see encode_prefix)
+            encoder_outputs = BaseModelOutput(
+                last_hidden_state=encode_layers(
+                    encoder,
+                    prefix_hidden_states,
+                    attention_mask,
+                    start=self.freeze_layers,
+                    head_mask=head_mask,
+                )
+            )
+        else:
+            encoder_outputs = encoder(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=True,
+            )
 
-        return getattr(self, self.config.model_type)(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=True,
-        )
+        if rows is not None:
+            # [PAD] evidence rows get zero vectors
+            hidden_states = encoder_outputs.last_hidden_state
+            encoder_outputs.last_hidden_state = hidden_states.new_zeros(
+                num_rows, *hidden_states.shape[1:]
+            ).index_copy(0, rows, hidden_states)
+        return encoder_outputs
+
+    def get_evidence_mask(self, evidence_mask):
+        return evidence_mask if self.skip_pad_evidence else None
 
     def forward(
         self,
@@ -187,7 +341,10 @@ class VerificationModel(PreTrainedModel):
         output_hidden_states=None,
         return_dict=None,
         class_weights=None,
+        evidence_mask=None,
+        prefix_hidden_states=None,
     ):
+        evidence_mask = self.get_evidence_mask(evidence_mask)
         encoder_outputs = self.encoder(
             input_ids,
             attention_mask=attention_mask,
@@ -198,9 +355,13 @@ class VerificationModel(PreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=True,
+            evidence_mask=evidence_mask,
+            prefix_hidden_states=prefix_hidden_states,
         )
 
-        logits = self.get_logits(encoder_outputs, attention_mask)
+        logits = self.get_logits(
+            encoder_outputs, attention_mask, evidence_mask=evidence_mask
+        )
 
         loss = None
         if labels is not None:
@@ -240,7 +401,10 @@ class VerificationJointModel(VerificationModel):
         output_hidden_states=None,
         return_dict=None,
         class_weights=None,
+        evidence_mask=None,
+        prefix_hidden_states=None,
     ):
+        evidence_mask = self.get_evidence_mask(evidence_mask)
         encoder_outputs = self.encoder(
             input_ids,
             attention_mask=attention_mask,
@@ -251,30 +415,43 @@ class VerificationJointModel(VerificationModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=True,
+            evidence_mask=evidence_mask,
+            prefix_hidden_states=prefix_hidden_states,
         )
 
         # batch*(evidence+1) x hidden
         features = encoder_outputs.last_hidden_state[:, 0]  # equiv. to [CLS]
 
         logits_s = self.sent_classifier(features)
-        logits_s = logits_s.view(-1, self.num_evidence + 1, self.sent_num_labels)[
+        logits_s = logits_s.view(-1, input_ids.size(1), self.sent_num_labels)[
             :, 1:
         ].contiguous()  # exclude claim
 
         selection_loss = None
         if selection_labels is not None:
             selection_labels = selection_labels[:, 1:].contiguous()  # exclude claim
-            loss_fct = CrossEntropyLoss()
-            selection_loss = loss_fct(
-                logits_s.view(-1, self.sent_num_labels), selection_labels.view(-1)
-            )
+            if evidence_mask is None:
+                loss_fct = CrossEntropyLoss()
+                selection_loss = loss_fct(
+                    logits_s.view(-1, self.sent_num_labels), selection_labels.view(-1)
+                )
+            else:
+                # average over the real evidence only
+                sent_mask = evidence_mask[:, 1:]
+                selection_labels = selection_labels.masked_fill(~sent_mask, -100)
+                loss_fct = CrossEntropyLoss(reduction="sum")
+                selection_loss = loss_fct(
+                    logits_s.view(-1, self.sent_num_labels), selection_labels.view(-1)
+                ) / sent_mask.sum().clamp(min=1)
 
         sent_scores = None
         if self.attn_bias_type != "none":
             # sent_scores:  batch x evidence
             sent_scores = torch.softmax(logits_s, dim=-1)[:, :, 1]
 
-        logits = self.get_logits(encoder_outputs, attention_mask, sent_scores)
+        logits = self.get_logits(
+            encoder_outputs, attention_mask, sent_scores, evidence_mask
+        )
 
         loss = None
         if labels is not None:
@@ -0,0 +1,65 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import re
+import unicodedata
+from functools import lru_cache
+
+# The replacements below must run in this order: several of them share the
+# "-" delimiters (e.g., "-COLON-RRB-"), so merging them into one alternation
+# would change the output. Literal patterns use str.replace, which gives the
+# same result as re.sub without the regex machinery.
+CLAIM_BRACKETS_RE = re.compile(r" \-LSB\-.*?\-RSB\-")
+SENTENCE_BRACKETS_RE = re.compile(" -LSB-.*-RSB-")
+EMPTY_PARENS_RE = re.compile(r"\( *\,? *\)")
+PARENS_PUNCT_RE = re.compile(r"\( *[;,]")
+
+# Claims repeat once per candidate sentence and titles once per sentence of
+# a page, so most calls hit the cache
+CLAIM_CACHE_SIZE = 1 << 12
+TITLE_CACHE_SIZE = 1 << 16
+SENTENCE_CACHE_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=CLAIM_CACHE_SIZE)
+def process_claim(text):
+    text = unicodedata.normalize("NFD", text)
+    if "-LSB-" in text:
+        text = CLAIM_BRACKETS_RE.sub("", text)
+    text = text.replace("-LRB- -RRB- ", "")
+    text = text.replace(" -LRB-", " ( ")
+    text = text.replace("-RRB-", " )")
+    text = text.replace("--", "-")
+    text = text.replace("``", '"')
+    text = text.replace("''", '"')
+    return text
+
+
+@lru_cache(maxsize=TITLE_CACHE_SIZE)
+def process_title(text):
+    text = unicodedata.normalize("NFD", text)
+    text = text.replace("_", " ")
+    text = text.replace(" -LRB-", " ( ")
+    text = text.replace("-RRB-", " )")
+    text = text.replace("-COLON-", ":")
+    return text
+
+
+@lru_cache(maxsize=SENTENCE_CACHE_SIZE)
+def process_sentence(text):
+    text = unicodedata.normalize("NFD", text)
+    if "-LSB-" in text:
+        text = SENTENCE_BRACKETS_RE.sub(" ", text)
+    text = text.replace(" -LRB- -RRB- ", " ")
+    text = text.replace("-LRB-", "(")
+    text = text.replace("-RRB-", ")")
+    text = text.replace("-COLON-", ":")
+    text = text.replace("_", " ")
+    if "(" in text:
+        text = EMPTY_PARENS_RE.sub("", text)
+        text = PARENS_PUNCT_RE.sub("(", text)
+    text = text.replace("--", "-")
+    text = text.replace("``", '"')
+    text = text.replace("''", '"')
+    return text
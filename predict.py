@@ -7,10 +7,22 @@ import datetime
 import pytorch_lightning as pl
 from pytorch_lightning.utilities import rank_zero_info
 from pathlib import Path
-from torch.utils.data import DataLoader, TensorDataset
+from attentions import AttentionWriter, set_attn_backend
+from feature_utils import FeatureDataset
 from train import FactCheckerTransformer
 
 
+class AttentionWriterCallback(pl.Callback):
+    def __init__(self, writer):
+        self.writer = writer
+
+    def on_test_batch_end(
+        self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
+    ):
+        # the rows map the batches back to the input order
+        self.writer.write(rows=batch["rows"].cpu().numpy())
+
+
 def build_args():
     parser = argparse.ArgumentParser()
     parser = pl.Trainer.add_argparse_args(parser)
@@ -18,6 +30,14 @@ def build_args():
     parser.add_argument("--in_file", type=str, required=True)
     parser.add_argument("--out_file", type=str, required=True)
     parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--dynamic_padding", action="store_true")
+    parser.add_argument("--pin_memory", action="store_true")
+    parser.add_argument("--prefetch_workers", type=int, default=0)
+    parser.add_argument(
+        "--attn_backend", default=None, choices=["reference", "chunked"]
+    )
+    parser.add_argument("--attn_chunk_size", type=int, default=None)
+    parser.add_argument("--attn_dir", type=str, default=None)
     args = parser.parse_args()
     return args
 
@@ -30,24 +50,38 @@ def main():
         checkpoint_path=args.checkpoint_file
     )
     model.hparams.out_file = args.out_file
+    model.hparams.dynamic_padding = args.dynamic_padding
+    model.hparams.pin_memory = args.pin_memory
+    model.hparams.prefetch_workers = args.prefetch_workers
+    if args.attn_backend is not None:
+        # the backends share their weights, so we can switch after loading
+        model.hparams.attn_backend = args.attn_backend
+        set_attn_backend(model, args.attn_backend, args.attn_chunk_size)
     model.eval()
     model.freeze()
 
     params = {}
     params["precision"] = model.hparams.precision
 
+    callbacks = []
+    if args.attn_dir is not None:
+        writer = AttentionWriter(model.model, args.attn_dir)
+        rank_zero_info(
+            f"Save the attention probabilities of {len(writer.handles)} layers "
+            f"to '{args.attn_dir}'"
+        )
+        callbacks.append(AttentionWriterCallback(writer))
+
     trainer = pl.Trainer.from_argparse_args(
-        args, logger=False, checkpoint_callback=False, **params
+        args, logger=False, checkpoint_callback=False, callbacks=callbacks, **params
     )
 
     test_file_path = Path(args.in_file)
     if not test_file_path.exists():
         raise RuntimeError(f"Cannot find '{test_file_path}'")
-    feature_list = model.create_features("test", test_file_path)
-    test_dataloader = DataLoader(
-        TensorDataset(*feature_list),
-        batch_size=args.batch_size,
-        shuffle=False,
+    features = model.create_features("test", test_file_path)
+    test_dataloader = model.make_dataloader(
+        FeatureDataset(features), args.batch_size, shuffle=False
     )
 
     trainer.test(model, test_dataloader)
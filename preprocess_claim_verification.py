@@ -7,7 +7,10 @@ import io
 import jsonlines
 import bisect
 from collections import defaultdict
+from functools import partial
 from tqdm import tqdm
+from fever_corpus import load_corpus
+from fever_doc_db import CachedFeverDocDB, FeverDocDB
 
 PAD_SENT = ["[PAD]", -1, "[PAD]"]  # doc_id, sent_id, sent_text
 
@@ -17,19 +20,43 @@ def pad_to_max(sent_list, max_evidence_per_claim):
         sent_list += [PAD_SENT] * (max_evidence_per_claim - len(sent_list))
 
 
-def get_all_sentences(corpus, pred_evidence, max_evidence_per_claim):
+def get_corpus_sentences(corpus, pairs):
+    docs = {}
+    sents = {}
+    for doc_id, sent_id in pairs:
+        if doc_id not in corpus:
+            continue
+        if doc_id not in docs:
+            docs[doc_id] = {i: s for (i, s) in corpus[doc_id]["lines"]}
+        if sent_id in docs[doc_id]:
+            sents[(doc_id, sent_id)] = docs[doc_id][sent_id]
+    return sents
+
+
+def get_cached_db_sentences(db, pairs):
+    docs = db.get_docs_sentences(dict.fromkeys(doc_id for doc_id, _ in pairs))
+    sents = {}
+    for doc_id, sent_id in pairs:
+        if docs[doc_id] is None:
+            continue
+        doc = dict(docs[doc_id])
+        if sent_id in doc:
+            sents[(doc_id, sent_id)] = doc[sent_id]
+    return sents
+
+
+def get_all_sentences(sents, pred_evidence, max_evidence_per_claim):
     sent_list = []
     for doc_id, sent_id, score in pred_evidence:
-        if doc_id not in corpus:
+        if (doc_id, sent_id) not in sents:
             continue
-        doc = {i: s for (i, s) in corpus[doc_id]["lines"]}
-        sent_list.append([doc_id, sent_id, doc[sent_id]])
+        sent_list.append([doc_id, sent_id, sents[(doc_id, sent_id)]])
     pad_to_max(sent_list, max_evidence_per_claim)
     return sent_list[:max_evidence_per_claim]
 
 
 def get_train_sentences(
-    corpus,
+    sents,
     evidence,
     pred_evidence,
     label,
@@ -38,27 +65,25 @@ def get_train_sentences(
     gold_evidence_set = set()
     for evidence_set in evidence:
         for _, _, doc_id, sent_id in evidence_set:
-            if doc_id is not None and doc_id in corpus:
+            if doc_id is not None and (doc_id, sent_id) in sents:
                 gold_evidence_set.add((doc_id, sent_id))
 
     train_evidence = []
     pos_sents = defaultdict(lambda: set())
     for doc_id, sent_id in sorted(gold_evidence_set):
-        doc = {i: s for (i, s) in corpus[doc_id]["lines"]}
         bisect.insort(
-            train_evidence, (-1, doc_id, sent_id, doc[sent_id])
+            train_evidence, (-1, doc_id, sent_id, sents[(doc_id, sent_id)])
         )  # assign negative 1 for gold evidence
         pos_sents[doc_id].add(sent_id)
 
     for doc_id, sent_id, score in pred_evidence:
-        if doc_id not in corpus:
+        if (doc_id, sent_id) not in sents:
             continue
         if doc_id in pos_sents and sent_id in pos_sents[doc_id]:
             continue
-        doc = {i: s for (i, s) in corpus[doc_id]["lines"]}
-        if sent_id not in doc:
-            continue
-        bisect.insort(train_evidence, (-float(score), doc_id, sent_id, doc[sent_id]))
+        bisect.insort(
+            train_evidence, (-float(score), doc_id, sent_id, sents[(doc_id, sent_id)])
+        )
 
     sent_list = []
     for score, doc_id, sent_id, sent_text in train_evidence:
@@ -72,19 +97,28 @@ def get_train_sentences(
         yield [doc_id, sent_id, sent_text, label, selection_label]
 
 
-def build_examples(args, corpus, line):
+def build_examples(args, get_sentences, line):
     claim_id = line["id"]
     claim_text = line["claim"]
     evidence = line.get("evidence", [])
     pred_evidence = line["predicted_evidence"]
     examples = []
 
+    # Look up only the sentences this claim needs
+    pairs = [(doc_id, sent_id) for doc_id, sent_id, _ in pred_evidence]
+    if args.training:
+        for evidence_set in evidence:
+            for _, _, doc_id, sent_id in evidence_set:
+                if doc_id is not None:
+                    pairs.append((doc_id, sent_id))
+    sents = get_sentences(pairs)
+
     if args.training:
         label = line["label"][0]
         examples.append([claim_id, claim_text] + PAD_SENT + [label, 0])
 
         for evidence_sent in get_train_sentences(
-            corpus,
+            sents,
             evidence,
             pred_evidence,
             label,
@@ -94,7 +128,7 @@ def build_examples(args, corpus, line):
     else:
         examples.append([claim_id, claim_text] + PAD_SENT)
         for evidence_sent in get_all_sentences(
-            corpus, pred_evidence, args.max_evidence_per_claim
+            sents, pred_evidence, args.max_evidence_per_claim
         ):
             examples.append([claim_id, claim_text] + evidence_sent)
 
@@ -103,7 +137,15 @@ def build_examples(args, corpus, line):
 
 def build_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--corpus", type=str, required=True)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--corpus", type=str)
+    group.add_argument("--db_file", type=str)
+    parser.add_argument(
+        "--immutable_db",
+        action="store_true",
+        help="open db_file as immutable; nothing may write it meanwhile",
+    )
+    parser.add_argument("--max_cached_docs", type=int, default=100000)
     parser.add_argument("--in_file", type=str, required=True)
     parser.add_argument("--out_file", type=str, required=True)
     parser.add_argument("--training", action="store_true")
@@ -111,20 +153,30 @@ def build_args():
     return parser.parse_args()
 
 
-def main():
-    args = build_args()
-    corpus = {doc["doc_id"]: doc for doc in jsonlines.open(args.corpus)}
-    lines = [line for line in jsonlines.open(args.in_file)]
-    out_examples = []
-
-    for line in tqdm(lines, total=len(lines), desc="Building examples"):
-        out_examples.extend(build_examples(args, corpus, line))
-
+def write_examples(args, get_sentences):
+    # Write the examples of each claim as soon as they are built
     print(f"Save to {args.out_file}")
     with io.open(args.out_file, "w", encoding="utf-8", errors="ignore") as out:
-        for e in out_examples:
-            e = list(map(str, e))
-            out.write("\t".join(e) + "\n")
+        for line in tqdm(jsonlines.open(args.in_file), desc="Building examples"):
+            for e in build_examples(args, get_sentences, line):
+                e = list(map(str, e))
+                out.write("\t".join(e) + "\n")
+
+
+def main():
+    args = build_args()
+    if args.db_file is not None:
+        with FeverDocDB(args.db_file, immutable=args.immutable_db) as db:
+            if db.has_table("sentences"):  # see build_sentence_table.py
+                write_examples(args, db.get_sentences)
+            else:
+                # parse each page once, as long as it stays in the cache
+                cached_db = CachedFeverDocDB(db, max_docs=args.max_cached_docs)
+                write_examples(args, partial(get_cached_db_sentences, cached_db))
+                print(f"Doc cache: {cached_db.stats()}")
+    else:
+        corpus = load_corpus(args.corpus)
+        write_examples(args, partial(get_corpus_sentences, corpus))
 
 
 if __name__ == "__main__":
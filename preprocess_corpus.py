@@ -3,43 +3,35 @@
 # All rights reserved.
 
 import argparse
+import heapq
+import io
+import json
 import jsonlines
-import re
-import unicodedata
-from functools import partial
+import os
 from multiprocessing import Pool, cpu_count
 from multiprocessing.util import Finalize
+from pathlib import Path
 from tqdm import tqdm
-from fever_doc_db import FeverDocDB
+from fever_doc_db import FeverDocDB, parse_doc_lines
 
 PROCESS_DB = None
 
 
-def get_sentences(lines):
-    sents = []
-    lines = re.split(r"\n(?=\d+)", lines)
-    for line in lines:
-        line = line.split("\t")
-        if len(line) < 2:
-            continue
-        sent_id = int(line[0])
-        sent_text = unicodedata.normalize("NFD", line[1].strip())
-        if not len(sent_text):
-            continue
-        sents.append([sent_id, sent_text])
-    return sents
-
-
-def get_documents(args, line):
-    global PROCESS_DB
+def get_doc_ids(line):
     evidence = line.get("evidence", [])
     pred_docs = line["predicted_pages"]
     gold_docs = [e[2] for es in evidence for e in es if e[2] is not None]
+    return set(gold_docs + pred_docs)
+
+
+def get_documents(doc_ids):
+    global PROCESS_DB
     docs = []
-    for doc_id in set(gold_docs + pred_docs):
-        lines = PROCESS_DB.get_doc_lines(doc_id)
+    docs_lines = PROCESS_DB.get_docs_lines(doc_ids)
+    for doc_id in doc_ids:  # keep the sorted order
+        lines = docs_lines.get(doc_id)
         if lines:
-            docs.append([doc_id, get_sentences(lines)])  # keep unnormalized doc_id
+            docs.append([doc_id, parse_doc_lines(lines)])  # keep unnormalized doc_id
     return docs
 
 
@@ -49,45 +41,126 @@ def init(db_class, db_opts):
     Finalize(PROCESS_DB, PROCESS_DB.close, exitpriority=100)
 
 
-def build_args():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--db_file", type=str, required=True)
-    parser.add_argument("--in_file", type=str, required=True)
-    parser.add_argument("--out_file", type=str, required=True)
-    parser.add_argument("--num_workers", type=int, default=8)
-    return parser.parse_args()
+def index_corpus(file_path):
+    """Return the sorted (doc_id, offset) pairs of the lines of a corpus file."""
+    index = []
+    with open(file_path, "rb") as f:
+        offset = f.tell()
+        for line in iter(f.readline, b""):
+            index.append((json.loads(line)["doc_id"], offset))
+            offset = f.tell()
+    index.sort()
+    return index
 
 
-def main():
-    args = build_args()
+def iter_corpus_lines(file_path, index):
+    if not index:
+        return
+    with open(file_path, "rb") as f:
+        for doc_id, offset in index:
+            f.seek(offset)
+            yield doc_id, f.readline().decode("utf-8")
+
+
+def load_missing(file_path):
+    """Return the ids of the pages that were not found in fever.db before."""
+    if not Path(file_path).exists():
+        return set()
+    with io.open(file_path, encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f}
 
-    lines = [line for line in jsonlines.open(args.in_file)]
+
+def fetch_documents(args, doc_ids):
+    chunks = [
+        doc_ids[i : i + args.chunk_size]
+        for i in range(0, len(doc_ids), args.chunk_size)
+    ]
 
     threads = min(args.num_workers, cpu_count())
     workers = Pool(
         threads,
         initializer=init,
-        initargs=(FeverDocDB, {"db_path": args.db_file}),
+        initargs=(
+            FeverDocDB,
+            {"db_path": args.db_file, "immutable": args.immutable_db},
+        ),
     )
 
-    _get_documents = partial(get_documents, args)
-
-    out_docs = []
-    for docs in tqdm(
-        workers.imap_unordered(_get_documents, lines),
-        total=len(lines),
-        desc="Getting documents",
-    ):
-        out_docs.extend(docs)
+    with tqdm(total=len(doc_ids), desc="Getting documents") as pbar:
+        for chunk, docs in zip(chunks, workers.imap(get_documents, chunks)):
+            for doc_id, sents in docs:
+                yield doc_id, sents
+            pbar.update(len(chunk))
 
     workers.close()
     workers.join()
 
-    out_docs = {docs[0]: docs[1] for docs in out_docs}
+
+def build_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_file", type=str, required=True)
+    parser.add_argument(
+        "--immutable_db",
+        action="store_true",
+        help="open db_file as immutable; nothing may write it meanwhile",
+    )
+    parser.add_argument("--in_file", type=str, nargs="+", required=True)
+    parser.add_argument("--out_file", type=str, required=True)
+    parser.add_argument("--update", action="store_true")
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--chunk_size", type=int, default=256)
+    return parser.parse_args()
+
+
+def main():
+    args = build_args()
+
+    # Each page is fetched once, however many claims refer to it
+    doc_ids = set()
+    for in_file in args.in_file:
+        for line in jsonlines.open(in_file):
+            doc_ids.update(get_doc_ids(line))
+
+    # Pages that are missing or empty in fever.db are listed next to the corpus,
+    # so that --update does not fetch them again
+    missing_file = f"{args.out_file}.missing"
+    index = []
+    missing = set()
+    if args.update and Path(args.out_file).exists():
+        index = index_corpus(args.out_file)
+        missing = load_missing(missing_file)
+        doc_ids.difference_update(doc_id for doc_id, _ in index)
+        doc_ids.difference_update(missing)
+        print(f"Found {len(index)} documents in {args.out_file}")
+        print(f"Found {len(missing)} missing documents in {missing_file}")
+        if not doc_ids:
+            print("No new documents to fetch")
+            return
+    doc_ids = sorted(doc_ids)
+
+    # Merge the new documents into the existing ones, both sorted by doc_id
+    tmp_file = f"{args.out_file}.tmp"
+    fetched = set()
+    with io.open(tmp_file, "w", encoding="utf-8") as fp:
+        out = jsonlines.Writer(fp)
+        for doc_id, doc in heapq.merge(
+            iter_corpus_lines(args.out_file, index),
+            fetch_documents(args, doc_ids),
+            key=lambda x: x[0],
+        ):
+            if isinstance(doc, str):
+                fp.write(doc)
+            else:
+                out.write({"doc_id": doc_id, "lines": doc})
+                fetched.add(doc_id)
+    os.replace(tmp_file, args.out_file)
+
+    missing.update(doc_id for doc_id in doc_ids if doc_id not in fetched)
+    with io.open(missing_file, "w", encoding="utf-8") as f:
+        for doc_id in sorted(missing):
+            f.write(doc_id + "\n")
+    print(f"{len(missing)} documents are missing or empty in {args.db_file}")
     print(f"Save to {args.out_file}")
-    with jsonlines.open(args.out_file, "w") as out:
-        for k, v in sorted(out_docs.items(), key=lambda x: x[0]):
-            out.write({"doc_id": k, "lines": v})
 
 
 if __name__ == "__main__":
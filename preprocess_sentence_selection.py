@@ -6,15 +6,29 @@ import argparse
 import jsonlines
 import random
 import io
+from functools import partial
+from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
-from collections import defaultdict
+from collections import defaultdict, deque
+from fever_corpus import load_corpus
+
+PROCESS_CORPUS = None
 
 
 def is_disambiguation_page(doc_id):
     return "-LRB-disambiguation-RRB-" in doc_id
 
 
-def sample_sentences(claim_id, corpus, doc_id, pos_sent_ids=set(), num_samples=1):
+def claim_rng(seed, claim_id, epoch=0):
+    """RNG for sampling the negatives of a claim, independent of other claims."""
+    if epoch == 0:
+        return random.Random(f"{seed}-{claim_id}")
+    return random.Random(f"{seed}-{epoch}-{claim_id}")
+
+
+def sample_sentences(
+    claim_id, corpus, doc_id, pos_sent_ids=set(), num_samples=1, rng=random
+):
     sents = []
     for sent_id, sent_text in corpus[doc_id]["lines"]:
         if sent_id in pos_sent_ids:
@@ -24,7 +38,7 @@ def sample_sentences(claim_id, corpus, doc_id, pos_sent_ids=set(), num_samples=1
     if num_samples is None:
         return sents
     else:
-        return random.sample(sents, min(len(sents), num_samples))
+        return rng.sample(sents, min(len(sents), num_samples))
 
 
 def get_all_sentences(claim_id, corpus, pred_docs):
@@ -42,6 +56,7 @@ def get_train_sentences(
     pred_docs,
     neg_ratio,
     neg_per_pred_doc,
+    rng=random,
 ):
     pos_sents = defaultdict(lambda: set())
     for evidence_set in evidence:
@@ -62,6 +77,7 @@ def get_train_sentences(
             doc_id,
             pos_sent_ids,
             num_samples=neg_ratio * len(pos_sent_ids),
+            rng=rng,
         ):
             yield evidence + (0,)
 
@@ -74,7 +90,7 @@ def get_train_sentences(
         ):
             continue
         for evidence in sample_sentences(
-            claim_id, corpus, doc_id, num_samples=neg_per_pred_doc
+            claim_id, corpus, doc_id, num_samples=neg_per_pred_doc, rng=rng
         ):
             yield evidence + (0,)
 
@@ -96,6 +112,7 @@ def build_examples(args, corpus, line):
             pred_docs,
             args.neg_ratio,
             args.neg_per_pred_doc,
+            rng=claim_rng(args.seed, claim_id),
         ):
             examples.append([claim_id, claim, doc_id, sent_id, sent_text, label])
     else:
@@ -106,6 +123,42 @@ def build_examples(args, corpus, line):
     return examples
 
 
+def init(corpus):
+    global PROCESS_CORPUS
+    PROCESS_CORPUS = corpus
+
+
+def build_chunk_examples(args, lines):
+    examples = []
+    for line in lines:
+        examples.extend(build_examples(args, PROCESS_CORPUS, line))
+    return examples
+
+
+def iter_chunks(lines, chunk_size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def imap_bounded(workers, fn, items, max_pending):
+    """Like workers.imap, but with at most 'max_pending' items submitted ahead
+    of the one being consumed, so the results do not pile up when the consumer
+    is slower than the workers."""
+    pending = deque()
+    for item in items:
+        pending.append(workers.apply_async(fn, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
 def build_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--corpus", type=str, required=True)
@@ -115,27 +168,36 @@ def build_args():
     parser.add_argument("--neg_per_pred_doc", type=int, default=2)
     parser.add_argument("--training", action="store_true")
     parser.add_argument("--seed", type=int, default=3435)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--chunk_size", type=int, default=256)
     return parser.parse_args()
 
 
 def main():
     args = build_args()
 
-    random.seed(args.seed)
-
-    corpus = {doc["doc_id"]: doc for doc in jsonlines.open(args.corpus)}
-
-    lines = [line for line in jsonlines.open(args.in_file)]
+    corpus = load_corpus(args.corpus)
 
-    out_examples = []
-    for line in tqdm(lines, total=len(lines), desc="Building examples"):
-        out_examples.extend(build_examples(args, corpus, line))
+    # Each claim samples with its own RNG, so the output does not depend on
+    # the number of workers or the chunking. At most two chunks per worker are
+    # in flight, so memory does not grow with the input file
+    threads = min(args.num_workers, cpu_count())
+    workers = Pool(threads, initializer=init, initargs=(corpus,))
 
     print(f"Save to {args.out_file}")
     with io.open(args.out_file, "w", encoding="utf-8", errors="ignore") as out:
-        for ex in out_examples:
-            ex = list(map(str, ex))
-            out.write("\t".join(ex) + "\n")
+        chunks = iter_chunks(jsonlines.open(args.in_file), args.chunk_size)
+        with tqdm(desc="Building examples") as pbar:
+            for examples in imap_bounded(
+                workers, partial(build_chunk_examples, args), chunks, 2 * threads
+            ):
+                for ex in examples:
+                    ex = list(map(str, ex))
+                    out.write("\t".join(ex) + "\n")
+                pbar.update(len(examples))
+
+    workers.close()
+    workers.join()
 
 
 if __name__ == "__main__":
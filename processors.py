@@ -2,10 +2,9 @@
 # Author: Canasai Kruengkrai (canasai@nii.ac.jp)
 # All rights reserved.
 
+import csv
 import io
 import numpy as np
-import unicodedata
-import re
 from dataclasses import dataclass
 from functools import partial
 from multiprocessing import Pool, cpu_count
@@ -19,6 +18,7 @@ from sklearn.metrics import (
 from tqdm import tqdm
 from transformers.data.processors.utils import DataProcessor
 from typing import List, Optional, Union
+from normalization import process_claim, process_title, process_sentence
 
 tokenizer = None
 
@@ -63,6 +63,16 @@ def save_predictions(task, preds, out_file):
         out.write(output + "\n")
 
 
+def label_from_example(example: InputExample, label_map, output_mode):
+    if example.label is None:
+        return None
+    if output_mode == "classification":
+        return label_map[example.label]
+    elif output_mode == "regression":
+        return float(example.label)
+    raise KeyError(output_mode)
+
+
 def convert_example_to_features(
     example,
     max_length,
@@ -72,15 +82,6 @@ def convert_example_to_features(
     if max_length is None:
         max_length = tokenizer.max_len
 
-    def label_from_example(example: InputExample):
-        if example.label is None:
-            return None
-        if output_mode == "classification":
-            return label_map[example.label]
-        elif output_mode == "regression":
-            return float(example.label)
-        raise KeyError(output_mode)
-
     inputs = tokenizer.encode_plus(
         example.text_a,
         example.text_b,
@@ -89,7 +90,7 @@ def convert_example_to_features(
         truncation=True,
         truncation_strategy="only_second",
     )
-    label = label_from_example(example)
+    label = label_from_example(example, label_map, output_mode)
     return InputFeatures(
         **inputs,
         label=label,
@@ -136,12 +137,123 @@ def convert_examples_to_features(
         features = list(
             tqdm(
                 p.imap(annotate_, examples, chunksize=32),
-                total=len(examples),
+                total=len(examples) if isinstance(examples, list) else None,
             )
         )
     return features
 
 
+def convert_features_to_arrays(features, output_mode):
+    """Stack InputFeatures into the arrays given by convert_examples_to_arrays."""
+    arrays = {}
+    for k in ["input_ids", "attention_mask", "token_type_ids"]:
+        if features and getattr(features[0], k) is not None:
+            arrays[k] = np.array([getattr(f, k) for f in features], dtype=np.int64)
+    label_dtype = np.float32 if output_mode == "regression" else np.int64
+    arrays["labels"] = np.array([f.label for f in features], dtype=label_dtype)
+    arrays["selection_labels"] = np.array(
+        [0 if f.selection_label is None else f.selection_label for f in features],
+        dtype=np.int64,
+    )
+    arrays["indices"] = np.array([f.index for f in features], dtype=np.int64)
+    return arrays
+
+
+def convert_batch_to_arrays(tokenizer, batch, max_length, label_map, output_mode):
+    # Claim-only examples have no text_b and cannot share a call with pairs
+    pair_rows = [i for i, ex in enumerate(batch) if ex.text_b is not None]
+    single_rows = [i for i, ex in enumerate(batch) if ex.text_b is None]
+    arrays = {}
+    for rows, texts in [
+        (
+            pair_rows,
+            (
+                [batch[i].text_a for i in pair_rows],
+                [batch[i].text_b for i in pair_rows],
+            ),
+        ),
+        (single_rows, ([batch[i].text_a for i in single_rows],)),
+    ]:
+        if not rows:
+            continue
+        inputs = tokenizer(
+            *texts,
+            max_length=max_length,
+            padding="max_length",
+            truncation=True,
+            truncation_strategy="only_second",
+            return_tensors="np",
+        )
+        for k, v in inputs.items():
+            if k not in arrays:
+                arrays[k] = np.zeros((len(batch), max_length), dtype=np.int64)
+            arrays[k][rows] = v
+    # also for an empty batch
+    for k in ["input_ids", "attention_mask"]:
+        if k not in arrays:
+            arrays[k] = np.zeros((len(batch), max_length), dtype=np.int64)
+
+    if output_mode == "regression":
+        arrays["labels"] = np.zeros(len(batch), dtype=np.float32)
+    else:
+        arrays["labels"] = np.zeros(len(batch), dtype=np.int64)
+    arrays["selection_labels"] = np.zeros(len(batch), dtype=np.int64)
+    arrays["indices"] = np.zeros(len(batch), dtype=np.int64)
+    for i, example in enumerate(batch):
+        arrays["labels"][i] = label_from_example(example, label_map, output_mode)
+        if example.selection_label is not None:
+            arrays["selection_labels"][i] = example.selection_label
+        arrays["indices"][i] = example.index
+    return arrays
+
+
+def convert_examples_to_arrays(
+    examples,
+    tokenizer,
+    max_length=None,
+    task=None,
+    label_list=None,
+    output_mode=None,
+    batch_size=1024,
+):
+    """Convert examples into numpy arrays with batched calls to a fast tokenizer.
+
+    Gives the same ids and masks as convert_examples_to_features, but leaves
+    the parallelism to the tokenizer instead of a process pool.
+    """
+    assert tokenizer.is_fast
+    if max_length is None:
+        max_length = tokenizer.max_len
+    if task is not None:
+        processor = fc_processors[task]()
+        if label_list is None:
+            label_list = processor.get_labels()
+        if output_mode is None:
+            output_mode = fc_output_modes[task]
+
+    label_map = {label: i for i, label in enumerate(label_list)}
+
+    chunks = []
+    batch = []
+    for example in tqdm(examples):
+        batch.append(example)
+        if len(batch) == batch_size:
+            chunks.append(
+                convert_batch_to_arrays(
+                    tokenizer, batch, max_length, label_map, output_mode
+                )
+            )
+            batch = []
+    if batch or not chunks:  # the rest, or empty arrays for no examples
+        chunks.append(
+            convert_batch_to_arrays(
+                tokenizer, batch, max_length, label_map, output_mode
+            )
+        )
+
+    return {k: np.concatenate([c[k] for c in chunks]) for k in chunks[0]}
+
+
 def compute_metrics(task, preds, labels):
     assert len(preds) == len(
         labels
@@ -167,43 +279,6 @@ def compute_metrics(task, preds, labels):
         raise KeyError(task)
 
 
-def process_claim(text):
-    text = unicodedata.normalize("NFD", text)
-    text = re.sub(r" \-LSB\-.*?\-RSB\-", "", text)
-    text = re.sub(r"\-LRB\- \-RRB\- ", "", text)
-    text = re.sub(" -LRB-", " ( ", text)
-    text = re.sub("-RRB-", " )", text)
-    text = re.sub("--", "-", text)
-    text = re.sub("``", '"', text)
-    text = re.sub("''", '"', text)
-    return text
-
-
-def process_title(text):
-    text = unicodedata.normalize("NFD", text)
-    text = re.sub("_", " ", text)
-    text = re.sub(" -LRB-", " ( ", text)
-    text = re.sub("-RRB-", " )", text)
-    text = re.sub("-COLON-", ":", text)
-    return text
-
-
-def process_sentence(text):
-    text = unicodedata.normalize("NFD", text)
-    text = re.sub(" -LSB-.*-RSB-", " ", text)
-    text = re.sub(" -LRB- -RRB- ", " ", text)
-    text = re.sub("-LRB-", "(", text)
-    text = re.sub("-RRB-", ")", text)
-    text = re.sub("-COLON-", ":", text)
-    text = re.sub("_", " ", text)
-    text = re.sub(r"\( *\,? *\)", "", text)
-    text = re.sub(r"\( *[;,]", "(", text)
-    text = re.sub("--", "-", text)
-    text = re.sub("``", '"', text)
-    text = re.sub("''", '"', text)
-    return text
-
-
 class SentenceSelectionProcessor(DataProcessor):
     def get_labels(self):
         """See base class."""
@@ -212,12 +287,15 @@ class SentenceSelectionProcessor(DataProcessor):
     def get_dummy_label(self):
         return "0"
 
-    def get_length(self, file_path):
-        return sum(1 for line in open(file_path, "r", encoding="utf-8-sig"))
+    @classmethod
+    def _iter_tsv(cls, input_file, quotechar=None):
+        """Like _read_tsv, but yields the lines one by one."""
+        with open(input_file, "r", encoding="utf-8-sig") as f:
+            yield from csv.reader(f, delimiter="\t", quotechar=quotechar)
 
     def get_examples(self, file_path, set_type, training=True, use_title=True):
-        examples = []
-        for (i, line) in enumerate(self._read_tsv(file_path)):
+        """Yield the examples of a .tsv file as they are read."""
+        for i, line in enumerate(self._iter_tsv(file_path)):
             guid = f"{set_type}-{i}"
             index = int(line[0])
             text_a = process_claim(line[1])
@@ -228,17 +306,14 @@ class SentenceSelectionProcessor(DataProcessor):
                 text_b = f"{title} : {sentence}" if use_title else sentence
             label = line[5] if training else self.get_dummy_label()
             selection_label = int(line[6]) if training and len(line) > 6 else None
-            examples.append(
-                InputExample(
-                    guid=guid,
-                    text_a=text_a,
-                    text_b=text_b,
-                    label=label,
-                    selection_label=selection_label,
-                    index=index,
-                )
+            yield InputExample(
+                guid=guid,
+                text_a=text_a,
+                text_b=text_b,
+                label=label,
+                selection_label=selection_label,
+                index=index,
             )
-        return examples
 
 
 class ClaimVerificationProcessor(SentenceSelectionProcessor):
@@ -2,10 +2,9 @@
 # Author: Canasai Kruengkrai (canasai@nii.ac.jp)
 # All rights reserved.
 
+import csv
 import io
 import numpy as np
-import unicodedata
-import re
 from dataclasses import dataclass
 from functools import partial
 from multiprocessing import Pool, cpu_count
@@ -19,6 +18,7 @@ from sklearn.metrics import (
 from tqdm import tqdm
 from transformers.data.processors.utils import DataProcessor
 from typing import List, Optional, Union
+from normalization import process_claim, process_title, process_sentence
 
 tokenizer = None
 
@@ -136,7 +136,7 @@ def convert_examples_to_features(
         features = list(
             tqdm(
                 p.imap(annotate_, examples, chunksize=32),
-                total=len(examples),
+                total=len(examples) if isinstance(examples, list) else None,
             )
         )
     return features
@@ -167,43 +167,6 @@ def compute_metrics(task, preds, labels):
         raise KeyError(task)
 
 
-def process_claim(text):
-    text = unicodedata.normalize("NFD", text)
-    text = re.sub(r" \-LSB\-.*?\-RSB\-", "", text)
-    text = re.sub(r"\-LRB\- \-RRB\- ", "", text)
-    text = re.sub(" -LRB-", " ( ", text)
-    text = re.sub("-RRB-", " )", text)
-    text = re.sub("--", "-", text)
-    text = re.sub("``", '"', text)
-    text = re.sub("''", '"', text)
-    return text
-
-
-def process_title(text):
-    text = unicodedata.normalize("NFD", text)
-    text = re.sub("_", " ", text)
-    text = re.sub(" -LRB-", " ( ", text)
-    text = re.sub("-RRB-", " )", text)
-    text = re.sub("-COLON-", ":", text)
-    return text
-
-
-def process_sentence(text):
-    text = unicodedata.normalize("NFD", text)
-    text = re.sub(" -LSB-.*-RSB-", " ", text)
-    text = re.sub(" -LRB- -RRB- ", " ", text)
-    text = re.sub("-LRB-", "(", text)
-    text = re.sub("-RRB-", ")", text)
-    text = re.sub("-COLON-", ":", text)
-    text = re.sub("_", " ", text)
-    text = re.sub(r"\( *\,? *\)", "", text)
-    text = re.sub(r"\( *[;,]", "(", text)
-    text = re.sub("--", "-", text)
-    text = re.sub("``", '"', text)
-    text = re.sub("''", '"', text)
-    return text
-
-
 class SentenceSelectionProcessor(DataProcessor):
     def get_labels(self):
         """See base class."""
@@ -212,12 +175,15 @@ class SentenceSelectionProcessor(DataProcessor):
     def get_dummy_label(self):
         return "0"
 
-    def get_length(self, file_path):
-        return sum(1 for line in open(file_path, "r", encoding="utf-8-sig"))
+    @classmethod
+    def _iter_tsv(cls, input_file, quotechar=None):
+        """Like _read_tsv, but yields the lines one by one."""
+        with open(input_file, "r", encoding="utf-8-sig") as f:
+            yield from csv.reader(f, delimiter="\t", quotechar=quotechar)
 
     def get_examples(self, file_path, set_type, training=True, use_title=True):
-        examples = []
-        for (i, line) in enumerate(self._read_tsv(file_path)):
+        """Yield the examples of a .tsv file as they are read."""
+        for i, line in enumerate(self._iter_tsv(file_path)):
             label = line[5] if training else self.get_dummy_label()  # ???
             # if training and label[0]=='N':
             #     continue
@@ -231,17 +197,14 @@ class SentenceSelectionProcessor(DataProcessor):
                 label = line[5] if training else self.get_dummy_label()
                 text_b = f"{title} : {sentence}" if use_title else sentence
             selection_label = int(line[6]) if training and len(line) > 6 else None
-            examples.append(
-                InputExample(
-                    guid=guid,
-                    text_a=text_a,
-                    text_b=text_b,
-                    label=label,
-                    selection_label=selection_label,
-                    index=index,
-                )
+            yield InputExample(
+                guid=guid,
+                text_a=text_a,
+                text_b=text_b,
+                label=label,
+                selection_label=selection_label,
+                index=index,
             )
-        return examples
 
 
 class ClaimVerificationProcessor(SentenceSelectionProcessor):
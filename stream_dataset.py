@@ -0,0 +1,224 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import jsonlines
+import math
+import numpy as np
+import random
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+from fever_corpus import load_corpus
+from normalization import process_claim, process_title, process_sentence
+from preprocess_sentence_selection import claim_rng, get_train_sentences
+
+
+class SentenceSelectionStream(IterableDataset):
+    """Sentence selection training batches sampled from the claims and the corpus.
+
+    Negatives are sampled anew each epoch with an RNG derived from the seed,
+    the epoch and the claim id, so no train.tsv has to be written. The first
+    epoch samples the same examples as preprocess_sentence_selection.py with
+    that seed. Claims are split across DDP ranks and DataLoader workers, and
+    each worker tokenizes its own batches with caches of the token ids of
+    claims and sentences (of up to `cache_size` entries each).
+
+    The number of examples of a claim does not depend on the sampled
+    negatives, so the length is known upfront. All ranks run the same number
+    of batches; ranks that run out of claims start over with new negatives.
+    """
+
+    def __init__(
+        self,
+        claims_file,
+        corpus,
+        tokenizer,
+        batch_size,
+        max_seq_length=128,
+        use_title=False,
+        neg_ratio=2,
+        neg_per_pred_doc=2,
+        seed=0,
+        dynamic_padding=False,
+        chunk_size=256,
+        num_workers=0,
+        num_replicas=None,
+        rank=None,
+        cache_size=1 << 20,
+    ):
+        self.claims = [
+            line
+            for line in jsonlines.open(claims_file)
+            if line["verifiable"] != "NOT VERIFIABLE"
+        ]
+        self.corpus = load_corpus(corpus) if isinstance(corpus, str) else corpus
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+        self.use_title = use_title
+        self.neg_ratio = neg_ratio
+        self.neg_per_pred_doc = neg_per_pred_doc
+        self.seed = seed
+        self.dynamic_padding = dynamic_padding
+        self.chunk_size = chunk_size
+        self.num_workers = num_workers
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.cache_size = cache_size
+        self.epoch = 0
+        self.claim_cache = {}
+        self.sent_cache = {}
+
+        # Count the examples (and labels) of each claim once
+        self.counts = np.zeros(len(self.claims), dtype=np.int64)
+        self.label_counts = np.zeros(2, dtype=np.int64)
+        for i, line in enumerate(self.claims):
+            for _, _, _, label in self.sample(line, random.Random(0)):
+                self.counts[i] += 1
+                self.label_counts[label] += 1
+        self.num_rows = int(self.counts.sum())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _replicas(self):
+        if self.num_replicas is not None:
+            return self.num_replicas, self.rank
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_world_size(), dist.get_rank()
+        return 1, 0
+
+    def _num_batches(self, worker_id):
+        # shard = rank + num_replicas * worker_id
+        num_replicas, _ = self._replicas()
+        num_shards = num_replicas * max(1, self.num_workers)
+        return max(
+            math.ceil(self.counts[shard::num_shards].sum() / self.batch_size)
+            for shard in range(num_replicas * worker_id, num_replicas * (worker_id + 1))
+        )
+
+    def __len__(self):
+        return sum(self._num_batches(w) for w in range(max(1, self.num_workers)))
+
+    def sample(self, line, rng):
+        return get_train_sentences(
+            line["id"],
+            self.corpus,
+            line.get("evidence", []),
+            line["predicted_pages"],
+            self.neg_ratio,
+            self.neg_per_pred_doc,
+            rng=rng,
+        )
+
+    def _claim_ids(self, line):
+        claim_id = line["id"]
+        if claim_id not in self.claim_cache:
+            if len(self.claim_cache) >= self.cache_size:
+                self.claim_cache.clear()
+            self.claim_cache[claim_id] = self.tokenizer.encode(
+                process_claim(line["claim"]), add_special_tokens=False
+            )
+        return self.claim_cache[claim_id]
+
+    def _sent_ids(self, doc_id, sent_id, sent_text):
+        key = (doc_id, sent_id)
+        if key not in self.sent_cache:
+            if len(self.sent_cache) >= self.cache_size:
+                self.sent_cache.clear()
+            sentence = process_sentence(sent_text)
+            if self.use_title:
+                sentence = f"{process_title(doc_id)} : {sentence}"
+            self.sent_cache[key] = self.tokenizer.encode(
+                sentence, add_special_tokens=False
+            )
+        return self.sent_cache[key]
+
+    def examples(self, line, epoch):
+        claim_ids = self._claim_ids(line)
+        rng = claim_rng(self.seed, line["id"], epoch)
+        for doc_id, sent_id, sent_text, label in self.sample(line, rng):
+            # an empty sentence gives the claim alone, as from the tokenizer call
+            # for train.tsv
+            inputs = self.tokenizer.prepare_for_model(
+                claim_ids,
+                self._sent_ids(doc_id, sent_id, sent_text) or None,
+                max_length=self.max_seq_length,
+                truncation=True,
+            )
+            yield inputs["input_ids"], inputs.get("token_type_ids"), label, line["id"]
+
+    def collate(self, examples):
+        max_length = self.max_seq_length
+        if self.dynamic_padding:
+            max_length = max(len(ex[0]) for ex in examples)
+        input_ids = np.full(
+            (len(examples), max_length), self.tokenizer.pad_token_id, dtype=np.int64
+        )
+        attention_mask = np.zeros((len(examples), max_length), dtype=np.int64)
+        token_type_ids = np.zeros((len(examples), max_length), dtype=np.int64)
+        for i, (ids, type_ids, _, _) in enumerate(examples):
+            input_ids[i, : len(ids)] = ids
+            attention_mask[i, : len(ids)] = 1
+            if type_ids is not None:
+                token_type_ids[i, : len(ids)] = type_ids
+        batch = {
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy(attention_mask),
+            "labels": torch.tensor([ex[2] for ex in examples]),
+            "indices": torch.tensor([ex[3] for ex in examples]),
+        }
+        if examples[0][1] is not None:
+            batch["token_type_ids"] = torch.from_numpy(token_type_ids)
+        return batch
+
+    def _batches(self, shard, num_shards, epoch):
+        rng = random.Random(f"{self.seed}-{epoch}-{shard}")
+        claim_indices = list(range(shard, len(self.claims), num_shards))
+        rng.shuffle(claim_indices)
+
+        # Shuffle the examples of a chunk of claims, carrying the remainder over
+        pending = []
+        for start in range(0, len(claim_indices), self.chunk_size):
+            for i in claim_indices[start : start + self.chunk_size]:
+                pending.extend(self.examples(self.claims[i], epoch))
+            rng.shuffle(pending)
+            num_ready = len(pending) // self.batch_size * self.batch_size
+            ready, pending = pending[:num_ready], pending[num_ready:]
+            if self.dynamic_padding:
+                ready.sort(key=lambda ex: len(ex[0]))
+            batches = [
+                ready[i : i + self.batch_size]
+                for i in range(0, num_ready, self.batch_size)
+            ]
+            rng.shuffle(batches)
+            for batch in batches:
+                yield self.collate(batch)
+        if pending:
+            yield self.collate(pending)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        assert num_workers == max(1, self.num_workers)
+        num_replicas, rank = self._replicas()
+        shard = rank + num_replicas * worker_id
+        num_shards = num_replicas * num_workers
+
+        num_batches = self._num_batches(worker_id)
+        repeat = 0
+        while num_batches > 0:
+            epoch = self.epoch if repeat == 0 else f"{self.epoch}.{repeat}"
+            num_yielded = 0
+            for batch in self._batches(shard, num_shards, epoch):
+                yield batch
+                num_yielded += 1
+                if num_yielded == num_batches:
+                    break
+            if num_yielded == 0:  # no claims in this shard
+                break
+            num_batches -= num_yielded
+            repeat += 1
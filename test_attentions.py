@@ -0,0 +1,99 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import pytest
+import torch
+from types import SimpleNamespace
+from attentions import MultiHeadedAttention, SelfAttention, set_gradient_checkpointing
+
+BIAS_TYPES = [None, "key_only", "value_only", "both", "dot"]
+HIDDEN_SIZE = 64
+NUM_ATTENTION_HEADS = 4
+BATCH_SIZE = 4
+ATOL = 1e-5
+
+
+def make_config():
+    return SimpleNamespace(
+        hidden_size=HIDDEN_SIZE,
+        num_attention_heads=NUM_ATTENTION_HEADS,
+        attention_probs_dropout_prob=0.0,
+        hidden_dropout_prob=0.0,
+    )
+
+
+def make_mask(batch_size, length):
+    # random padding; the last example is fully masked
+    lengths = torch.randint(1, length + 1, (batch_size,))
+    lengths[-1] = 0
+    return (torch.arange(length) < lengths.unsqueeze(1)).long()
+
+
+def forward_backward(module, inputs):
+    for x in inputs:
+        x.grad = None
+    y = module(*inputs)
+    y.pow(2).sum().backward()
+    grads = [x.grad.clone() for x in inputs if x.grad is not None]
+    grads += [p.grad.clone() for p in module.parameters()]
+    module.zero_grad()
+    return y.detach(), grads
+
+
+def assert_same(ref, new, inputs):
+    new.load_state_dict(ref.state_dict())
+    y_ref, g_ref = forward_backward(ref, inputs)
+    y_new, g_new = forward_backward(new, inputs)
+    assert (y_ref - y_new).abs().max() < ATOL
+    assert len(g_ref) == len(g_new)
+    for a, b in zip(g_ref, g_new):
+        # relative to the largest gradient of the tensor, if above 1
+        assert (a - b).abs().max() / a.abs().max().clamp(min=1) < ATOL
+
+
+@pytest.mark.parametrize(
+    "length, chunk_size",
+    [
+        (256, 64),  # the chunks divide the length
+        (300, 128),  # a shorter last chunk
+        (300, 7),
+        (50, 128),  # a single chunk
+    ],
+)
+def test_chunked_self_attention(length, chunk_size):
+    # word/sentence attention: self-attention with a key mask
+    torch.manual_seed(0)
+    ref = SelfAttention(make_config())
+    new = SelfAttention(make_config(), backend="chunked", chunk_size=chunk_size)
+    x = torch.randn(BATCH_SIZE, length, HIDDEN_SIZE, requires_grad=True)
+    mask = make_mask(BATCH_SIZE, length).unsqueeze(1)
+    assert_same(ref, new, (x, mask))
+
+
+@pytest.mark.parametrize("bias_type", BIAS_TYPES)
+@pytest.mark.parametrize("chunk_size", [2, 5, 128])
+def test_chunked_aggregation(bias_type, chunk_size, num_evidence=5):
+    # aggregation: claims attend to their evidence
+    torch.manual_seed(0)
+    ref = MultiHeadedAttention(make_config(), bias_type)
+    new = MultiHeadedAttention(
+        make_config(), bias_type, backend="chunked", chunk_size=chunk_size
+    )
+    claims = torch.randn(BATCH_SIZE, HIDDEN_SIZE, requires_grad=True)
+    sents = torch.randn(BATCH_SIZE, num_evidence, HIDDEN_SIZE, requires_grad=True)
+    mask = make_mask(BATCH_SIZE, num_evidence).unsqueeze(1)
+    bias = torch.rand(BATCH_SIZE, num_evidence, requires_grad=True)
+    assert_same(ref, new, (claims, sents, sents, mask, bias))
+
+
+@pytest.mark.parametrize("requires_grad", [True, False])
+def test_gradient_checkpointing(requires_grad, length=20):
+    # on top of a frozen encoder, none of the inputs requires grad
+    torch.manual_seed(0)
+    ref = SelfAttention(make_config())
+    new = SelfAttention(make_config())
+    set_gradient_checkpointing(new)
+    x = torch.randn(BATCH_SIZE, length, HIDDEN_SIZE, requires_grad=requires_grad)
+    mask = make_mask(BATCH_SIZE, length).unsqueeze(1)
+    assert_same(ref, new, (x, mask))
@@ -0,0 +1,70 @@
+# Copyright (c) 2021, Yamagishi Laboratory, National Institute of Informatics
+# Author: Canasai Kruengkrai (canasai@nii.ac.jp)
+# All rights reserved.
+
+import pytest
+import torch
+from transformers import BertConfig, BertModel
+from modeling_utils import (
+    enable_gradient_checkpointing,
+    enable_input_require_grads,
+    encode_layers,
+    encode_prefix,
+    frozen_modules,
+)
+
+BATCH_SIZE = 4
+LENGTH = 16
+ATOL = 1e-5
+
+
+def make_encoder(gradient_checkpointing, freeze_layers=1):
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=100,
+        hidden_size=32,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        intermediate_size=64,
+        hidden_dropout_prob=0.0,
+        attention_probs_dropout_prob=0.0,
+    )
+    encoder = BertModel(config, add_pooling_layer=False)
+    # as train.py does for --freeze_layers
+    for module in frozen_modules(encoder, freeze_layers):
+        for p in module.parameters():
+            p.requires_grad = False
+    if gradient_checkpointing:
+        enable_gradient_checkpointing(encoder)
+        enable_input_require_grads(encoder)
+    return encoder.train()
+
+
+def encoder_grads(encoder, from_prefix, freeze_layers=1):
+    torch.manual_seed(1)
+    input_ids = torch.randint(1, 100, (BATCH_SIZE, LENGTH))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[0, LENGTH // 2 :] = 0
+    if from_prefix:  # as with --cache_frozen_activations
+        hidden_states = encode_prefix(
+            encoder, input_ids, attention_mask, None, freeze_layers
+        )
+        hidden_states = encode_layers(
+            encoder, hidden_states, attention_mask, start=freeze_layers
+        )
+    else:
+        hidden_states = encoder(
+            input_ids, attention_mask=attention_mask
+        ).last_hidden_state
+    hidden_states[:, 0].pow(2).sum().backward()
+    return {n: p.grad for n, p in encoder.named_parameters() if p.requires_grad}
+
+
+@pytest.mark.parametrize("from_prefix", [False, True])
+def test_gradient_checkpointing_above_frozen_layers(from_prefix):
+    ref = encoder_grads(make_encoder(False), from_prefix)
+    new = encoder_grads(make_encoder(True), from_prefix)
+    assert ref.keys() == new.keys()
+    for n, grad in new.items():
+        assert grad is not None, n
+        assert (ref[n] - grad).abs().max() < ATOL, n
@@ -7,21 +7,47 @@ import datetime
 import torch
 import numpy as np
 import pytorch_lightning as pl
+import torch.nn.functional as F
 from argparse import Namespace
 from pathlib import Path
-from torch.utils.data import DataLoader, TensorDataset
-from pytorch_lightning.callbacks import EarlyStopping, ModelCheckpoint
+from torch.utils.data import DataLoader
+from pytorch_lightning.callbacks import EarlyStopping, GPUStatsMonitor, ModelCheckpoint
 from pytorch_lightning.core.decorators import auto_move_data
 from pytorch_lightning.utilities import rank_zero_info
+from feature_utils import (
+    TOKEN_TYPE_MODELS,
+    BatchDataset,
+    BucketBatchSampler,
+    FeatureDataset,
+    FrozenActivationCache,
+    FeatureStore,
+    RowBatchSampler,
+    compact_features,
+    expand_features,
+    is_feature_store,
+    row_lengths,
+    save_feature_store,
+    trim_batch,
+)
+from feature_cache import feature_fingerprint, touch
 from lightning_base import BaseTransformer, generic_train
+from stream_dataset import SentenceSelectionStream
 from modeling_base import BaseModel
+from modeling_utils import (
+    disable_dropout,
+    enable_input_require_grads,
+    encoder_layers,
+    frozen_modules,
+)
 from modeling_verification import VerificationModel, VerificationJointModel
 from processors import (
     fc_processors,
     fc_num_labels,
     fc_output_modes,
     compute_metrics,
+    convert_examples_to_arrays,
     convert_examples_to_features,
+    convert_features_to_arrays,
     save_predictions,
 )
 
@@ -33,6 +59,9 @@ MODEL_NAMES_MAPPING = {
 
 
 class FactCheckerTransformer(BaseTransformer):
+    # the batch samplers shard the batches across DDP ranks themselves
+    replace_sampler_ddp = False
+
     def __init__(self, hparams, **kwargs):
         if type(hparams) == dict:
             hparams = Namespace(**hparams)
@@ -46,54 +75,86 @@ class FactCheckerTransformer(BaseTransformer):
             model=model,
             config=None if model is None else model.config,
         )
+        self.freeze_parameters()
+        self.frozen_cache = None
 
     @auto_move_data
     def forward(self, **inputs):
         return self.model(**inputs)
 
+    def _feature_params(self):
+        hparams = self.hparams
+        return {
+            "task": hparams.task,
+            "labels": fc_processors[hparams.task]().get_labels(),
+            "tokenizer": type(self.tokenizer).__name__,
+            "tokenizer_name": self.tokenizer.name_or_path,
+            "vocab_size": len(self.tokenizer),
+            "model_type": self.config.model_type,
+            "max_seq_length": hparams.max_seq_length,
+            "use_title": hparams.use_title,
+            "training": self.training,
+            "num_evidence": (
+                None if "base" in hparams.model_name else hparams.num_evidence
+            ),
+            "joint": self.training and "joint" in hparams.model_name,
+        }
+
+    def _feature_file(self, mode):
+        cache_dir = getattr(self.hparams, "feature_cache_dir", None)
+        if cache_dir is None:
+            return super()._feature_file(mode)
+
+        # Key the features on what they are built from, so experiments with
+        # the same inputs share one cache entry
+        file_path = Path(self.hparams.data_dir) / f"{mode}.tsv"
+        if not file_path.exists():
+            return super()._feature_file(mode)
+        if not hasattr(self, "_fingerprints"):
+            self._fingerprints = {}
+        if mode not in self._fingerprints:
+            self._fingerprints[mode] = feature_fingerprint(
+                file_path, **self._feature_params()
+            )
+        return Path(cache_dir) / self._fingerprints[mode]
+
     def create_features(self, set_type, file_path):
         rank_zero_info(f"Creating features from '{file_path}'")
         hparams = self.hparams
         processor = fc_processors[hparams.task]()
+        # a generator: the examples are converted as they are read
         examples = processor.get_examples(
             file_path, set_type, self.training, hparams.use_title
         )
-        num_examples = processor.get_length(file_path)
-        features = convert_examples_to_features(
-            examples,
-            self.tokenizer,
-            max_length=hparams.max_seq_length,
-            task=hparams.task,
-            threads=hparams.num_workers,
+        if self.tokenizer.is_fast:
+            arrays = convert_examples_to_arrays(
+                examples,
+                self.tokenizer,
+                max_length=hparams.max_seq_length,
+                task=hparams.task,
+            )
+        else:
+            features = convert_examples_to_features(
+                examples,
+                self.tokenizer,
+                max_length=hparams.max_seq_length,
+                task=hparams.task,
+                threads=hparams.num_workers,
+            )
+            arrays = convert_features_to_arrays(features, hparams.fc_output_mode)
+        rank_zero_info(f"{len(arrays['labels'])} examples")
+
+        # Wrap whole arrays without copying them row by row
+        input_ids = torch.from_numpy(arrays["input_ids"])
+        attention_mask = torch.from_numpy(arrays["attention_mask"])
+        token_type_ids = torch.from_numpy(
+            arrays.get("token_type_ids", np.zeros_like(arrays["input_ids"]))
         )
-
-        def empty_tensor_1():
-            return torch.empty(num_examples, dtype=torch.long)
-
-        def empty_tensor_2():
-            return torch.empty((num_examples, hparams.max_seq_length), dtype=torch.long)
-
-        input_ids = empty_tensor_2()
-        attention_mask = empty_tensor_2()
-        token_type_ids = empty_tensor_2()
-        if hparams.fc_output_mode == "classification":
-            labels = empty_tensor_1()
-        elif hparams.fc_output_mode == "regression":
-            labels = empty_tensor_1().float()
-        indices = empty_tensor_1()
+        indices = torch.from_numpy(arrays["indices"])
+        labels = torch.from_numpy(arrays["labels"])
         selection_labels = None
         if self.training and "joint" in hparams.model_name:
-            selection_labels = empty_tensor_1()
-
-        for i, feature in enumerate(features):
-            input_ids[i] = torch.tensor(feature.input_ids)
-            attention_mask[i] = torch.tensor(feature.attention_mask)
-            if feature.token_type_ids is not None:
-                token_type_ids[i] = torch.tensor(feature.token_type_ids)
-            labels[i] = torch.tensor(feature.label)
-            indices[i] = torch.tensor(feature.index)
-            if selection_labels is not None and feature.selection_label is not None:
-                selection_labels[i] = torch.tensor(feature.selection_label)
+            selection_labels = torch.from_numpy(arrays["selection_labels"])
 
         feature_list = [input_ids, attention_mask, token_type_ids, indices, labels]
         if selection_labels is not None:
@@ -104,19 +165,31 @@ class FactCheckerTransformer(BaseTransformer):
             feature_list = reshape_features(
                 feature_list, self.hparams.num_evidence, self.hparams.max_seq_length
             )
-        return feature_list
+        return self.compact_features(feature_list)
+
+    def compact_features(self, feature_list):
+        return compact_features(
+            feature_list, self.config.model_type, len(self.tokenizer)
+        )
 
     def prepare_data(self):
         if self.training:
             for set_type in ["train", "dev", "test"]:
+                if set_type == "train" and self.streaming:
+                    continue
                 feature_file = self._feature_file(set_type)
-                if not feature_file.exists() or self.hparams.overwrite_cache:
+                cached = feature_file.is_file() or is_feature_store(feature_file)
+                if not cached or self.hparams.overwrite_cache:
                     file_path = Path(self.hparams.data_dir) / f"{set_type}.tsv"
                     if not file_path.exists():
                         continue
-                    feature_list = self.create_features(set_type, file_path)
+                    features = self.create_features(set_type, file_path)
                     rank_zero_info(f"Saving features to '{feature_file}'")
-                    torch.save(feature_list, feature_file)
+                    meta = {
+                        "source_file": str(file_path.resolve()),
+                        "params": self._feature_params(),
+                    }
+                    save_feature_store(features, feature_file, meta=meta)
 
     def init_parameters(self):
         base_name = self.config.model_type  # e.g., bert, roberta, ...
@@ -129,35 +202,260 @@ class FactCheckerTransformer(BaseTransformer):
                 else:
                     p.data.zero_()
 
+    def freeze_parameters(self):
+        frozen = {}
+        freeze_layers = getattr(self.hparams, "freeze_layers", 0)
+        if freeze_layers > 0:
+            encoder = getattr(self.model, self.config.model_type)
+            for module in frozen_modules(encoder, freeze_layers):
+                # the frozen layers run without dropout, as they do from
+                # --cache_frozen_activations (see encode_prefix)
+                disable_dropout(module)
+                frozen.update((id(p), p) for p in module.parameters())
+            rank_zero_info(
+                f"Freeze the embeddings and {freeze_layers} of "
+                f"{len(encoder_layers(encoder))} layers"
+            )
+        for fp in self.hparams.freeze_params:
+            matched = [(id(p), p) for n, p in self.model.named_parameters() if fp in n]
+            if not matched:
+                raise ValueError(f"No parameters match --freeze_params '{fp}'")
+            rank_zero_info(f"Freeze {len(matched)} parameter tensors matching '{fp}'")
+            frozen.update(matched)
+        if not frozen:
+            return
+
+        for p in frozen.values():
+            p.requires_grad = False
+        num_frozen = sum(p.numel() for p in frozen.values())
+        num_params = sum(p.numel() for p in self.model.parameters())
+        rank_zero_info(f"Freeze {num_frozen} of {num_params} parameters")
+
+        encoder = getattr(self.model, self.config.model_type)
+        if getattr(self.hparams, "gradient_checkpointing", False) and any(
+            p.requires_grad for p in encoder.parameters()
+        ):
+            # otherwise the checkpointed layers above the frozen ones get no
+            # gradients (see enable_input_require_grads)
+            enable_input_require_grads(encoder)
+
+    def create_frozen_cache(self, dataset, batch_sampler):
+        hparams = self.hparams
+        if hparams.freeze_layers <= 0:
+            raise ValueError("--cache_frozen_activations requires --freeze_layers")
+        # encode_prefix runs the layers of BERT-like encoders only
+        encoder_layers(getattr(self.model, self.config.model_type))
+
+        # each rank caches its own rows, which it sees in every epoch
+        rows = batch_sampler.rows()
+        seqs_per_row = 1 if "base" in hparams.model_name else hparams.num_evidence + 1
+        path = Path(hparams.default_root_dir) / f"frozen_cache.{self.global_rank}.npy"
+        self.frozen_cache = FrozenActivationCache(
+            path,
+            rows,
+            len(dataset),
+            seqs_per_row,
+            hparams.max_seq_length,
+            self.config.hidden_size,
+            num_shards=self.trainer.world_size,
+        )
+        rank_zero_info(
+            f"Cache the hidden states after {hparams.freeze_layers} frozen layers "
+            f"of {len(rows)} rows per rank in '{path}' "
+            f"({self.frozen_cache.nbytes / (1 << 30):.1f} GB per rank)"
+        )
+
+    def get_prefix_hidden_states(self, batch, inputs):
+        input_ids = inputs["input_ids"]
+        max_length = input_ids.size(-1)
+        pad_length = self.hparams.max_seq_length - max_length
+
+        def compute(indices):
+            indices = indices.to(input_ids.device)
+
+            def pad(x, value=0):
+                # the cache keeps the states of whole rows, as without
+                # dynamic padding
+                x = x.reshape(-1, max_length)[indices]
+                return F.pad(x, (0, pad_length), value=value)
+
+            token_type_ids = inputs.get("token_type_ids")
+            return self.model.encode_prefix(
+                pad(input_ids, self.tokenizer.pad_token_id),
+                pad(inputs["attention_mask"]),
+                None if token_type_ids is None else pad(token_type_ids),
+            )
+
+        needed = None
+        skip_pad_evidence = getattr(self.model, "skip_pad_evidence", False)
+        if skip_pad_evidence and "evidence_mask" in inputs:
+            # [PAD] evidence rows are not encoded
+            needed = inputs["evidence_mask"].reshape(-1).cpu().numpy()
+        hidden_states = self.frozen_cache.lookup(
+            batch["rows"].cpu().numpy(), max_length, compute, needed
+        )
+        return hidden_states.to(input_ids.device)
+
+    def on_train_end(self):
+        if self.frozen_cache is not None:
+            self.frozen_cache.close()
+            self.frozen_cache = None
+
+    @property
+    def streaming(self):
+        return getattr(self.hparams, "train_claims", None) is not None
+
+    def set_class_weights(self, samples_per_class):
+        assert len(samples_per_class) == self.model.num_labels
+        num_samples = samples_per_class.sum()
+        weights = num_samples / (len(samples_per_class) * samples_per_class.float())
+        self.class_weights = weights / weights.sum()
+        rank_zero_info(f"Class weights: {self.class_weights}")
+
+    def get_stream_dataloader(self, batch_size):
+        hparams = self.hparams
+        if hparams.task != "sentence-selection" or hparams.model_name != "base":
+            raise ValueError("--train_claims is only supported for sentence selection")
+        if hparams.corpus is None:
+            raise ValueError("--train_claims requires --corpus")
+        if getattr(hparams, "cache_frozen_activations", False):
+            # the rows change every epoch
+            raise ValueError(
+                "--cache_frozen_activations does not support --train_claims"
+            )
+
+        rank_zero_info(f"Sampling training examples from '{hparams.train_claims}'")
+        dataset = SentenceSelectionStream(
+            hparams.train_claims,
+            hparams.corpus,
+            self.tokenizer,
+            batch_size,
+            max_seq_length=hparams.max_seq_length,
+            use_title=hparams.use_title,
+            neg_ratio=hparams.neg_ratio,
+            neg_per_pred_doc=hparams.neg_per_pred_doc,
+            seed=max(0, hparams.seed),
+            dynamic_padding=hparams.dynamic_padding,
+            num_workers=hparams.prefetch_workers,
+        )
+        rank_zero_info(f"{dataset.num_rows} examples per epoch")
+        if hparams.class_weighting:
+            self.set_class_weights(torch.from_numpy(dataset.label_counts))
+        # not persistent workers, so that each epoch starts them with its seed
+        return DataLoader(
+            dataset,
+            batch_size=None,
+            pin_memory=hparams.pin_memory,
+            num_workers=hparams.prefetch_workers,
+        )
+
     def get_dataloader(self, mode, batch_size):
+        if mode == "train" and self.streaming:
+            return self.get_stream_dataloader(batch_size)
+
         feature_file = self._feature_file(mode)
-        if not feature_file.exists():
+        if is_feature_store(feature_file):
+            rank_zero_info(f"Loading features from '{feature_file}'")
+            dataset = FeatureStore(feature_file)
+            if getattr(self.hparams, "feature_cache_dir", None) is not None:
+                touch(feature_file)
+        elif feature_file.is_file():  # cached by torch.save
+            rank_zero_info(f"Loading features from '{feature_file}'")
+            features = torch.load(feature_file)
+            if isinstance(features, list):  # cached before features were compacted
+                features = self.compact_features(features)
+            dataset = FeatureDataset(features)
+        else:
             return None
 
-        rank_zero_info(f"Loading features from '{feature_file}'")
-        feature_list = torch.load(feature_file)
         if self.hparams.class_weighting and mode == "train":
-            labels = feature_list[4]
+            labels = dataset.column("labels")
             assert labels.dim() == 1
-            classes, samples_per_class = torch.unique(labels, return_counts=True)
-            assert len(classes) == self.model.num_labels
-            weights = len(labels) / (len(classes) * samples_per_class.float())
-            self.class_weights = weights / weights.sum()
-            rank_zero_info(f"Class weights: {self.class_weights}")
+            _, samples_per_class = torch.unique(labels, return_counts=True)
+            self.set_class_weights(samples_per_class)
+        cache_frozen = (
+            getattr(self.hparams, "cache_frozen_activations", False) and mode == "train"
+        )
+        dataloader = self.make_dataloader(
+            dataset,
+            batch_size,
+            shuffle=mode == "train" and self.training,
+            fixed_ranks=cache_frozen,
+        )
+        if cache_frozen:
+            self.create_frozen_cache(dataset, dataloader.sampler)
+        return dataloader
+
+    def make_dataloader(self, dataset, batch_size, shuffle=False, fixed_ranks=False):
+        hparams = self.hparams
+        if "evidence_mask" in dataset.columns:
+            evidence_mask = dataset.column("evidence_mask")[:, 1:]
+            skip_pad_evidence = getattr(hparams, "skip_pad_evidence", False)
+            rank_zero_info(
+                f"[PAD] evidence: {1.0 - evidence_mask.float().mean():.3f} of the "
+                f"evidence rows (skip_pad_evidence={skip_pad_evidence})"
+            )
+
+        seed = max(0, hparams.seed)
+        collate_fn = None
+        if getattr(hparams, "dynamic_padding", False):
+            # Batch rows of similar lengths and pad each batch to its longest row
+            batch_sampler = BucketBatchSampler(
+                row_lengths(dataset),
+                batch_size,
+                shuffle=shuffle,
+                seed=seed,
+                fixed_ranks=fixed_ranks,
+            )
+            collate_fn = trim_batch
+            max_length = hparams.max_seq_length
+            rank_zero_info(
+                f"Padding ratio: {batch_sampler.padding_ratio():.3f} "
+                f"(vs. {batch_sampler.padding_ratio(max_length):.3f} with "
+                f"max_seq_length={max_length})"
+            )
+        else:
+            batch_sampler = RowBatchSampler(
+                len(dataset),
+                batch_size,
+                shuffle=shuffle,
+                seed=seed,
+                fixed_ranks=fixed_ranks,
+            )
+
+        # Fetch whole batches rather than collating rows one by one
+        num_workers = getattr(hparams, "prefetch_workers", 0)
         return DataLoader(
-            TensorDataset(*feature_list),
-            batch_size=batch_size,
-            shuffle=True if mode == "train" and self.training else False,
+            BatchDataset(dataset),
+            sampler=batch_sampler,
+            batch_size=None,
+            collate_fn=collate_fn,
+            pin_memory=getattr(hparams, "pin_memory", False),
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
         )
 
+    def on_train_epoch_start(self):
+        if self.streaming:
+            self.train_loader.dataset.set_epoch(self.current_epoch)
+        else:
+            self.train_loader.sampler.set_epoch(self.current_epoch)
+
     def build_inputs(self, batch):
-        inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[4]}
-        if len(batch) == 6:
-            inputs["selection_labels"] = batch[5]
+        batch = expand_features(batch)
+        inputs = {
+            "input_ids": batch["input_ids"],
+            "attention_mask": batch["attention_mask"],
+            "labels": batch["labels"],
+        }
+        if "selection_labels" in batch:
+            inputs["selection_labels"] = batch["selection_labels"]
+        if "evidence_mask" in batch:
+            inputs["evidence_mask"] = batch["evidence_mask"]
         if self.config.model_type not in {"distilbert", "bart"}:
             inputs["token_type_ids"] = (
-                batch[2]
-                if self.config.model_type in ["bert", "xlnet", "albert"]
+                batch["token_type_ids"]
+                if self.config.model_type in TOKEN_TYPE_MODELS
                 else None
             )
 
@@ -167,9 +465,24 @@ class FactCheckerTransformer(BaseTransformer):
 
     def training_step(self, batch, batch_idx):
         inputs = self.build_inputs(batch)
+        if self.frozen_cache is not None:
+            inputs["prefix_hidden_states"] = self.get_prefix_hidden_states(
+                batch, inputs
+            )
         outputs = self(**inputs)
         loss = outputs[0]
-        self.log_dict({"train_loss": loss, "lr": self.lr_scheduler.get_last_lr()[-1]})
+        pad_ratio = 1.0 - inputs["attention_mask"].float().mean()
+        logs = {
+            "train_loss": loss,
+            "lr": self.lr_scheduler.get_last_lr()[-1],
+            "pad_ratio": pad_ratio,
+        }
+        if getattr(self.hparams, "log_gpu_stats", False) and loss.is_cuda:
+            # peak of the allocated memory so far, e.g., to compare micro-batch
+            # sizes with and without --gradient_checkpointing
+            max_memory = torch.cuda.max_memory_allocated(loss.device)
+            logs["max_memory_gb"] = max_memory / (1 << 30)
+        self.log_dict(logs)
         return loss
 
     def validation_step(self, batch, batch_idx):
@@ -185,6 +498,7 @@ class FactCheckerTransformer(BaseTransformer):
             "loss": loss.detach().cpu(),
             "preds": preds.detach().cpu().numpy(),
             "labels": inputs["labels"].detach().cpu().numpy(),
+            "rows": batch["rows"].cpu().numpy(),
         }
 
     def test_step(self, batch, batch_idx):
@@ -196,6 +510,9 @@ class FactCheckerTransformer(BaseTransformer):
         )
         labels = np.concatenate([x["labels"] for x in outputs], axis=0)
         preds = np.concatenate([x["preds"] for x in outputs], axis=0)
+        # batches may not follow the order of the rows, e.g., with dynamic padding
+        order = np.argsort(np.concatenate([x["rows"] for x in outputs]), kind="stable")
+        labels, preds = labels[order], preds[order]
         results = {
             **{"loss": avg_loss},
             **compute_metrics(self.hparams.task, preds, labels),
@@ -220,21 +537,41 @@ class FactCheckerTransformer(BaseTransformer):
         BaseTransformer.add_model_specific_args(parser)
         parser.add_argument("--task", type=str, required=True)
         parser.add_argument("--overwrite_cache", action="store_true")
+        parser.add_argument("--feature_cache_dir", type=str, default=None)
         parser.add_argument("--save_all_checkpoints", action="store_true")
         parser.add_argument("--max_seq_length", type=int, default=512)
+        parser.add_argument("--dynamic_padding", action="store_true")
+        parser.add_argument("--pin_memory", action="store_true")
+        parser.add_argument("--prefetch_workers", type=int, default=0)
+        parser.add_argument("--train_claims", type=str, default=None)
+        parser.add_argument("--corpus", type=str, default=None)
+        parser.add_argument("--neg_ratio", type=int, default=2)
+        parser.add_argument("--neg_per_pred_doc", type=int, default=2)
         parser.add_argument("--num_evidence", type=int, default=5)
+        parser.add_argument("--skip_pad_evidence", action="store_true")
         parser.add_argument("--use_title", action="store_true")
         parser.add_argument("--aggregate_mode", type=str, default="attn")
         parser.add_argument("--word_attn", action="store_true")
+        parser.add_argument(
+            "--word_attn_mode", default="dense", choices=["dense", "sparse"]
+        )
         parser.add_argument("--sent_attn", action="store_true")
         parser.add_argument("--lambda_joint", type=float, default=1.0)
+        parser.add_argument("--gradient_checkpointing", action="store_true")
+        parser.add_argument("--log_gpu_stats", action="store_true")
         parser.add_argument(
             "--attn_bias_type",
             default="none",
             choices=["none", "key_only", "value_only", "both", "dot"],
         )
+        parser.add_argument(
+            "--attn_backend", default="reference", choices=["reference", "chunked"]
+        )
+        parser.add_argument("--attn_chunk_size", type=int, default=128)
         parser.add_argument("--no_init", nargs="+", default=[])
         parser.add_argument("--freeze_params", nargs="+", default=[])
+        parser.add_argument("--freeze_layers", type=int, default=0)
+        parser.add_argument("--cache_frozen_activations", action="store_true")
         parser.add_argument("--classifier_dropout_prob", type=float, default=0.1)
         parser.add_argument("--class_weighting", action="store_true")
         return parser
@@ -309,6 +646,9 @@ def main():
             EarlyStopping(monitor=monitor, mode=mode, patience=args.patience)
         )
 
+    if args.log_gpu_stats and args.gpus:
+        callbacks.append(GPUStatsMonitor(intra_step_time=True, inter_step_time=True))
+
     trainer = generic_train(model, args, callbacks)
 
     if args.do_predict:
@@ -58,7 +58,6 @@ class FactCheckerTransformer(BaseTransformer):
         examples = processor.get_examples(
             file_path, set_type, self.training, hparams.use_title
         )
-        num_examples = processor.get_length(file_path)
         features = convert_examples_to_features(
             examples,
             self.tokenizer,
@@ -66,6 +65,8 @@ class FactCheckerTransformer(BaseTransformer):
             task=hparams.task,
             threads=hparams.num_workers,
         )
+        num_examples = len(features)
+        rank_zero_info(f"{num_examples} examples")
 
         def empty_tensor_1():
             return torch.empty(num_examples, dtype=torch.long)